@@ -15,14 +15,16 @@ Setup:
 
 from __future__ import annotations
 
-import io
+import asyncio
 import json
 import os
+import re
 from pathlib import Path
 from typing import Any
 
 import numpy as np
-import soundfile as sf
+
+from backend.audio import resample, to_mono, to_wav_pcm16
 
 # Official ACRCloud SDK
 try:
@@ -46,13 +48,20 @@ ACRCLOUD_HOST = os.getenv("ACRCLOUD_HOST", "")
 ACRCLOUD_ACCESS_KEY = os.getenv("ACRCLOUD_ACCESS_KEY", "")
 ACRCLOUD_ACCESS_SECRET = os.getenv("ACRCLOUD_ACCESS_SECRET", "")
 
+# Credentials come from the environment and never change at runtime
+_CONFIGURED = bool(_sdk_available and ACRCLOUD_HOST and ACRCLOUD_ACCESS_KEY and ACRCLOUD_ACCESS_SECRET)
+
+# The SDK's fingerprint extractor works on 8 kHz mono PCM; sending audio at
+# that rate skips its internal resample and shrinks the buffer ~5x
+SDK_SAMPLE_RATE = 8000
+
 # Lazy-initialized recognizer instance
 _recognizer: ACRCloudRecognizer | None = None
 
 
 def is_configured() -> bool:
     """True if ACRCloud credentials are set."""
-    return bool(_sdk_available and ACRCLOUD_HOST and ACRCLOUD_ACCESS_KEY and ACRCLOUD_ACCESS_SECRET)
+    return _CONFIGURED
 
 
 def _get_recognizer() -> ACRCloudRecognizer:
@@ -73,29 +82,70 @@ def _get_recognizer() -> ACRCloudRecognizer:
     return _recognizer
 
 
+def _peak(audio: np.ndarray) -> float:
+    """Return ``max(|audio|)`` without materialising ``np.abs(audio)``."""
+    if not len(audio):
+        return 0.0
+    return float(max(audio.max(), -audio.min()))
+
+
+def _to_sdk_rate(audio: np.ndarray, sr: int) -> tuple[np.ndarray, int]:
+    """Polyphase-resample mono *audio* to :data:`SDK_SAMPLE_RATE`."""
+    return resample(audio, sr, SDK_SAMPLE_RATE), SDK_SAMPLE_RATE
+
+
 def _audio_to_wav_bytes(audio: np.ndarray, sr: int) -> bytes:
     """Convert numpy audio to WAV bytes for the SDK."""
-    if audio.ndim > 1:
-        audio = np.mean(audio, axis=1)
+    audio = to_mono(np.asarray(audio, dtype=np.float32))
 
     # Skip first 0.5s of mic startup noise
     skip_samples = min(int(sr * 0.5), len(audio) // 4)
     audio = audio[skip_samples:]
 
     # Peak-normalize to ensure good signal level
-    peak = np.max(np.abs(audio))
+    peak = _peak(audio)
     if peak > 0.001:
-        audio = audio / peak * 0.95
+        gain = 0.95 / peak
         print(f"[acrcloud] Audio normalized: peak was {peak:.4f}, now 0.95")
     else:
+        gain = 1.0
         print(f"[acrcloud] WARNING: Audio is nearly silent (peak={peak:.6f})")
 
     duration = len(audio) / sr
     print(f"[acrcloud] Audio: {duration:.1f}s, {len(audio)} samples @ {sr} Hz")
 
-    buf = io.BytesIO()
-    sf.write(buf, audio, sr, format="WAV", subtype="PCM_16")
-    return buf.getvalue()
+    # Normalisation is folded into the PCM_16 conversion, no scaled copy
+    return bytes(to_wav_pcm16(audio, sr, gain))  # the SDK wants immutable bytes
+
+
+# The response's "status" member is a flat object: {"msg": …, "code": …, …}
+_STATUS_RE = re.compile(r'"status"\s*:\s*(\{[^{}]*\})')
+_JSON_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def _top_level(prefix: str) -> bool:
+    """True if JSON text *prefix* ends directly inside the outermost object."""
+    bare = _JSON_STRING_RE.sub("", prefix)
+    return '"' not in bare and bare.count("{") - bare.count("}") == 1
+
+
+def _peek_status(result_str: str | None) -> dict[str, Any] | None:
+    """Parse only the top-level ``status`` object of an SDK response.
+
+    Returns None when it cannot be isolated; the caller then falls back to
+    parsing the full document.
+    """
+    if not isinstance(result_str, str):
+        return None
+    # A nested "status" (e.g. inside a music entry) must not be mistaken for it
+    m = next((m for m in _STATUS_RE.finditer(result_str) if _top_level(result_str[:m.start()])), None)
+    if m is None:
+        return None
+    try:
+        status = json.loads(m.group(1))
+    except json.JSONDecodeError:
+        return None
+    return status if isinstance(status, dict) else None
 
 
 def recognize(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
@@ -116,6 +166,7 @@ def recognize(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
             print("[acrcloud] Not configured - set ACRCLOUD_HOST, ACRCLOUD_ACCESS_KEY, ACRCLOUD_ACCESS_SECRET")
         return None
 
+    audio, sr = _to_sdk_rate(to_mono(np.asarray(audio, dtype=np.float32)), sr)
     wav_bytes = _audio_to_wav_bytes(audio, sr)
     recognizer = _get_recognizer()
 
@@ -124,6 +175,15 @@ def recognize(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
     print(f"[acrcloud] Sending {len(wav_bytes)} bytes to SDK recognize_by_filebuffer...")
     result_str = recognizer.recognize_by_filebuffer(wav_bytes, 0)
 
+    # Most attempts are "no result": read just the status object and bail
+    # out before parsing the rest of the response
+    status = _peek_status(result_str)
+    if status is not None and status.get("code", 0) != 0:
+        msg = status.get("msg", "")
+        print(f"[acrcloud] Response status: {status['code']} - {msg}")
+        print(f"[acrcloud] No match: {msg}")
+        return None
+
     try:
         data = json.loads(result_str)
     except (json.JSONDecodeError, TypeError) as e:
@@ -217,3 +277,18 @@ def recognize(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
         "confidence": round(score, 1),
         "source": "acrcloud",
     }
+
+
+async def recognize_async(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
+    """Awaitable :func:`recognize` — runs the blocking SDK call in a worker thread."""
+    return await asyncio.to_thread(recognize, audio, sr)
+
+
+async def recognize_many(
+    clips: list[tuple[np.ndarray, int]],
+) -> list[dict[str, Any] | None]:
+    """Recognize several ``(audio, sr)`` clips concurrently.
+
+    Results are returned in the same order as *clips*.
+    """
+    return list(await asyncio.gather(*(recognize_async(a, s) for a, s in clips)))
@@ -6,18 +6,38 @@ and similar-vibes recommendations.
 
 Supports two modes:
   1. **OpenAI / compatible API** — set MUSICA_LLM_API_KEY env var
-  2. **Audio-feature heuristic** — zero-dependency fallback using librosa
+  2. **Audio-feature heuristic** — offline fallback using NumPy / SciPy
 """
 
 from __future__ import annotations
 
+import atexit
+import hashlib
 import json
 import os
 import textwrap
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Any
 
-import librosa
+import httpx
 import numpy as np
+from scipy import fft as sp_fft
+from scipy.signal import find_peaks
+
+from backend.audio import to_mono
+
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # stdlib fallback
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _json_loads = json.loads
 
 # ── LLM configuration ───────────────────────────────────────────────────────
 
@@ -31,6 +51,24 @@ LLM_MODEL = os.getenv("MUSICA_LLM_MODEL", "gpt-4o-mini")
 GEMINI_API_KEY = os.getenv("MUSICA_GEMINI_API_KEY", "")
 GEMINI_MODEL = os.getenv("MUSICA_GEMINI_MODEL", "gemini-2.5-flash")
 
+# Fail fast on connect, allow the model time to answer
+_HTTP_TIMEOUT = httpx.Timeout(15.0, connect=3.05)
+
+# Keep-alive client shared by the LLM and Gemini paths (one TLS handshake
+# per host); built at import so concurrent analyses never race to create it
+_http_client = httpx.Client(
+    http2=True,
+    timeout=_HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+)
+atexit.register(_http_client.close)
+
+
+# Analyses are deterministic per song, so replays are served from memory
+_CACHE_SIZE = 512
+_heuristic_cache: OrderedDict[tuple, dict[str, Any]] = OrderedDict()
+_heuristic_lock = threading.Lock()
+
 
 def analyze_song(
     title: str,
@@ -43,31 +81,30 @@ def analyze_song(
 
     Tries Gemini first, then OpenAI, then heuristic fallback.
     """
+    if audio is not None:
+        audio = np.asarray(audio, dtype=np.float32)
+
     # Try Gemini analysis (richer, free tier)
     if GEMINI_API_KEY:
         try:
-            return _gemini_analysis(title, artist, album)
+            return dict(_gemini_analysis(title, artist, album))
         except Exception as e:
             print(f"[analyzer] Gemini analysis failed: {e}")
 
     # Try LLM-based analysis (OpenAI)
     if LLM_API_KEY:
         try:
-            return _llm_analysis(title, artist, album)
+            return dict(_llm_analysis(title, artist, album))
         except Exception:
             pass
 
     # Heuristic path -- works offline, uses audio features
-    return _heuristic_analysis(title, artist, album, audio, sr)
+    return _cached_heuristic_analysis(title, artist, album, audio, sr)
 
 
 # ── LLM path ────────────────────────────────────────────────────────────────
 
-def _llm_analysis(title: str, artist: str, album: str) -> dict[str, Any]:
-    """Call an OpenAI-compatible chat endpoint for song analysis."""
-    import urllib.request
-
-    prompt = textwrap.dedent(f"""\
+_LLM_PROMPT = textwrap.dedent("""\
         You are a music expert. Analyze this song and return ONLY valid JSON
         (no markdown fences, no extra text).
 
@@ -83,47 +120,49 @@ def _llm_analysis(title: str, artist: str, album: str) -> dict[str, Any]:
           "lyrics_meaning": "1-2 sentences about the lyrical themes",
           "similar_vibes": ["Song1 - Artist1", "Song2 - Artist2", "Song3 - Artist3"]
         }}
-    """)
+""")
 
-    body = json.dumps({
-        "model": LLM_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.7,
-        "max_tokens": 300,
-    }).encode()
+# Static part of the request body; only "messages" changes per call
+_LLM_BODY: dict[str, Any] = {
+    "model": LLM_MODEL,
+    "temperature": 0.7,
+    "max_tokens": 300,
+}
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _llm_analysis(title: str, artist: str, album: str) -> dict[str, Any]:
+    """Call an OpenAI-compatible chat endpoint for song analysis."""
+    prompt = _LLM_PROMPT.format(title=title, artist=artist, album=album)
+    body = _json_dumps({**_LLM_BODY, "messages": [{"role": "user", "content": prompt}]})
 
-    req = urllib.request.Request(
+    resp = _http_client.post(
         f"{LLM_BASE_URL}/chat/completions",
-        data=body,
+        content=body,
         headers={
             "Content-Type": "application/json",
             "Authorization": f"Bearer {LLM_API_KEY}",
         },
     )
-
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        data = json.loads(resp.read())
+    resp.raise_for_status()
+    data = _json_loads(resp.content)
 
     raw = data["choices"][0]["message"]["content"].strip()
     # Strip markdown fences if present
     if raw.startswith("```"):
         raw = raw.split("\n", 1)[1]
         raw = raw.rsplit("```", 1)[0]
-    return json.loads(raw)
+    return _json_loads(raw)
 
 
 # ── Gemini path ──────────────────────────────────────────────────────────────
 
-def _gemini_analysis(title: str, artist: str, album: str) -> dict[str, Any]:
-    """Call Gemini API for rich song analysis."""
-    import urllib.request
-
-    prompt = textwrap.dedent(f"""\
+_GEMINI_PROMPT = textwrap.dedent("""\
         You are a music expert and cultural analyst. Analyze this song in detail.
 
         Song: "{title}"
         Artist: "{artist}"
-        Album: "{album or 'Unknown'}" 
+        Album: "{album}" 
 
         Return ONLY valid JSON (no markdown fences, no extra text) with this structure:
         {{
@@ -136,67 +175,61 @@ def _gemini_analysis(title: str, artist: str, album: str) -> dict[str, Any]:
           "fun_fact": "One interesting fact about this song or artist",
           "similar_vibes": ["Song1 - Artist1", "Song2 - Artist2", "Song3 - Artist3"]
         }}
-    """)
+""")
+
+_GEMINI_GENERATION_CONFIG: dict[str, Any] = {
+    "temperature": 0.7,
+    "maxOutputTokens": 1024,
+    "responseMimeType": "application/json",
+}
+
+_GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
 
-    body = json.dumps({
-        "contents": [{"parts": [{"text": prompt}]}],
-        "generationConfig": {
-            "temperature": 0.7,
-            "maxOutputTokens": 1024,
-            "responseMimeType": "application/json",
-        },
-    }).encode()
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
-    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+@lru_cache(maxsize=_CACHE_SIZE)
+def _gemini_analysis(title: str, artist: str, album: str) -> dict[str, Any]:
+    """Call Gemini API for rich song analysis."""
+    prompt = _GEMINI_PROMPT.format(title=title, artist=artist, album=album or "Unknown")
+    body = _json_dumps({
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": _GEMINI_GENERATION_CONFIG,
+    })
 
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        data = json.loads(resp.read())
+    resp = _http_client.post(_GEMINI_URL, content=body, headers={"Content-Type": "application/json"})
+    resp.raise_for_status()
+    data = _json_loads(resp.content)
 
     raw = data["candidates"][0]["content"]["parts"][0]["text"].strip()
     if raw.startswith("```"):
         raw = raw.split("\n", 1)[1]
         raw = raw.rsplit("```", 1)[0]
 
-    result = json.loads(raw)
+    result = _json_loads(raw)
     print(f"[analyzer] Gemini analysis: {result.get('category', '?')} / {result.get('mood', '?')}")
     return result
 
 
 # ── Heuristic (offline) path ────────────────────────────────────────────────
 
-# Mood / genre maps derived from audio features
-_ENERGY_MOODS = [
-    (0.2, "Calm and peaceful"),
-    (0.4, "Mellow and relaxed"),
-    (0.6, "Upbeat and groovy"),
-    (0.8, "Energetic and driving"),
-    (1.0, "Intense and powerful"),
-]
-
-_VALENCE_LABELS = [
-    (0.25, "melancholic"),
-    (0.50, "bittersweet"),
-    (0.75, "uplifting"),
-    (1.00, "euphoric"),
-]
-
-_TEMPO_GENRES = [
-    (80, "Ambient"),
-    (100, "R&B"),
-    (120, "Pop"),
-    (135, "Dance"),
-    (150, "Electronic"),
-    (999, "Drum & Bass"),
-]
-
-_SPECTRAL_GENRES = [
-    (2000, "Jazz"),
-    (3000, "Soul"),
-    (4500, "Pop"),
-    (6000, "Rock"),
-    (9999, "Electronic"),
-]
+# Mood / genre maps derived from audio features: a value maps to the label
+# of the first upper bound it does not exceed
+_ENERGY_THRESHOLDS = np.array([0.2, 0.4, 0.6, 0.8, 1.0])
+_ENERGY_MOODS = (
+    "Calm and peaceful",
+    "Mellow and relaxed",
+    "Upbeat and groovy",
+    "Energetic and driving",
+    "Intense and powerful",
+)
+
+_VALENCE_THRESHOLDS = np.array([0.25, 0.50, 0.75, 1.00])
+_VALENCE_LABELS = ("melancholic", "bittersweet", "uplifting", "euphoric")
+
+_TEMPO_THRESHOLDS = np.array([80, 100, 120, 135, 150, 999])
+_TEMPO_GENRES = ("Ambient", "R&B", "Pop", "Dance", "Electronic", "Drum & Bass")
+
+_SPECTRAL_THRESHOLDS = np.array([2000, 3000, 4500, 6000, 9999])
+_SPECTRAL_GENRES = ("Jazz", "Soul", "Pop", "Rock", "Electronic")
 
 _SIMILAR_DB: dict[str, list[str]] = {
     "Pop": ["Shape of You - Ed Sheeran", "Blinding Lights - The Weeknd", "Levitating - Dua Lipa"],
@@ -211,6 +244,33 @@ _SIMILAR_DB: dict[str, list[str]] = {
 }
 
 
+def _cached_heuristic_analysis(
+    title: str,
+    artist: str,
+    album: str,
+    audio: np.ndarray | None,
+    sr: int,
+) -> dict[str, Any]:
+    """:func:`_heuristic_analysis` memoized on the song and a digest of *audio*."""
+    if audio is None or len(audio) < sr:
+        return _heuristic_analysis(title, artist, album, audio, sr)
+
+    digest = hashlib.blake2b(np.ascontiguousarray(audio), digest_size=8).digest()
+    key = (title, artist, album, sr, audio.shape, audio.dtype.str, digest)
+    with _heuristic_lock:
+        cached = _heuristic_cache.get(key)
+        if cached is not None:
+            _heuristic_cache.move_to_end(key)
+            return dict(cached)
+
+    result = _heuristic_analysis(title, artist, album, audio, sr)
+    with _heuristic_lock:
+        _heuristic_cache[key] = result
+        if len(_heuristic_cache) > _CACHE_SIZE:
+            _heuristic_cache.popitem(last=False)
+    return dict(result)
+
+
 def _heuristic_analysis(
     title: str,
     artist: str,
@@ -234,36 +294,40 @@ def _heuristic_analysis(
         }
 
     # ── Extract features ─────────────────────────────────────────────────
-    if audio.ndim > 1:
-        audio = np.mean(audio, axis=1)
+    audio = to_mono(np.asarray(audio, dtype=np.float32))
+
+    mag = _magnitude_spectrogram(audio)  # (frames, bins) — the only STFT
+    power = mag ** 2
 
     # Tempo
-    tempo, _ = librosa.beat.beat_track(y=audio, sr=sr)
-    tempo_val = float(np.atleast_1d(tempo)[0])
+    tempo_val = _estimate_tempo(power, sr)
 
     # RMS energy (0-1 normalised)
-    rms = float(np.mean(librosa.feature.rms(y=audio)))
+    n = len(audio) - len(audio) % _HOP
+    rms = float(np.mean(np.sqrt(np.mean(audio[:n].reshape(-1, _HOP) ** 2, axis=1))))
     energy = min(rms / 0.15, 1.0)
 
     # Spectral centroid (brightness)
-    centroid = float(np.mean(librosa.feature.spectral_centroid(y=audio, sr=sr)))
+    freqs = _bin_freqs(sr)
+    centroid = float(np.mean((mag @ freqs) / np.maximum(mag.sum(axis=1), 1e-10)))
 
     # Chroma — rough major/minor proxy  (valence-ish)
-    chroma = librosa.feature.chroma_cqt(y=audio, sr=sr)
+    chroma = power @ _chroma_map(sr)
+    chroma /= np.maximum(chroma.max(axis=1, keepdims=True), 1e-10)
     chroma_std = float(np.std(chroma))
     valence = min(chroma_std / 0.35, 1.0)
 
     # Spectral contrast → timbral richness
-    contrast = librosa.feature.spectral_contrast(y=audio, sr=sr)
+    contrast = _spectral_contrast(mag, freqs)
     richness = float(np.mean(contrast)) / 30.0  # normalise
 
     # ── Derive labels ────────────────────────────────────────────────────
-    mood_base = next(m for thr, m in _ENERGY_MOODS if energy <= thr)
-    valence_label = next(v for thr, v in _VALENCE_LABELS if valence <= thr)
+    mood_base = _bucket(_ENERGY_THRESHOLDS, _ENERGY_MOODS, energy)
+    valence_label = _bucket(_VALENCE_THRESHOLDS, _VALENCE_LABELS, valence)
     mood = f"{mood_base}, {valence_label}"
 
-    genre_tempo = next(g for thr, g in _TEMPO_GENRES if tempo_val <= thr)
-    genre_spectral = next(g for thr, g in _SPECTRAL_GENRES if centroid <= thr)
+    genre_tempo = _bucket(_TEMPO_THRESHOLDS, _TEMPO_GENRES, tempo_val)
+    genre_spectral = _bucket(_SPECTRAL_THRESHOLDS, _SPECTRAL_GENRES, centroid)
     if genre_tempo == genre_spectral:
         genre_blend = f"{genre_tempo} + Contemporary"
     else:
@@ -313,3 +377,82 @@ def _heuristic_analysis(
             "valence": round(valence, 2),
         },
     }
+
+
+# ── Feature helpers ─────────────────────────────────────────────────────────
+
+def _bucket(thresholds: np.ndarray, labels: tuple[str, ...], value: float) -> str:
+    """Label of the first threshold >= *value* (the last label past the end)."""
+    idx = int(np.searchsorted(thresholds, value, side="left"))
+    return labels[min(idx, len(labels) - 1)]
+
+
+_N_FFT = 2048
+_HOP = 512
+_WINDOW = np.hanning(_N_FFT).astype(np.float32)
+_CONTRAST_BANDS = 6
+_CONTRAST_FMIN = 200.0
+
+
+def _magnitude_spectrogram(audio: np.ndarray) -> np.ndarray:
+    """Return ``|STFT|`` of *audio* as a ``(frames, bins)`` array."""
+    if len(audio) < _N_FFT:
+        audio = np.pad(audio, (0, _N_FFT - len(audio)))
+    frames = np.lib.stride_tricks.sliding_window_view(audio, _N_FFT)[::_HOP]
+    return np.abs(sp_fft.rfft(frames * _WINDOW, axis=-1, workers=-1))
+
+
+@lru_cache(maxsize=8)
+def _bin_freqs(sr: int) -> np.ndarray:
+    """Centre frequency (Hz) of each STFT bin at *sr*, as read-only float32."""
+    freqs = np.fft.rfftfreq(_N_FFT, 1.0 / sr).astype(np.float32)
+    freqs.flags.writeable = False  # shared between calls
+    return freqs
+
+
+@lru_cache(maxsize=8)
+def _chroma_map(sr: int) -> np.ndarray:
+    """One-hot ``(bins, 12)`` matrix folding STFT bins onto pitch classes."""
+    freqs = np.fft.rfftfreq(_N_FFT, 1.0 / sr)
+    mapping = np.zeros((len(freqs), 12), dtype=np.float32)
+    audible = (freqs >= 27.5) & (freqs <= 5000.0)
+    midi = 12.0 * np.log2(freqs[audible] / 440.0) + 69.0
+    mapping[np.flatnonzero(audible), np.rint(midi).astype(int) % 12] = 1.0
+    mapping.flags.writeable = False  # shared between calls
+    return mapping
+
+
+def _spectral_contrast(mag: np.ndarray, freqs: np.ndarray) -> np.ndarray:
+    """Peak-minus-valley (dB) per octave band, shape ``(bands + 1, frames)``."""
+    edges = _CONTRAST_FMIN * 2.0 ** np.arange(_CONTRAST_BANDS)
+    bounds = np.concatenate(([0], np.searchsorted(freqs, edges), [len(freqs)]))
+    mag_db = np.log10(np.maximum(mag, np.float32(1e-10)))
+    mag_db *= np.float32(10.0)
+    bands = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if hi <= lo:
+            continue
+        peak, valley = np.percentile(mag_db[:, lo:hi], [85, 15], axis=1)
+        bands.append(peak - valley)
+    return np.asarray(bands)
+
+
+def _estimate_tempo(power: np.ndarray, sr: int) -> float:
+    """Coarse BPM from the autocorrelation of a spectral-flux onset envelope."""
+    onset_env = np.diff(power.sum(axis=1)).clip(min=0)
+    onset_env -= onset_env.mean()
+
+    frame_rate = sr / _HOP
+    lag_min = int(np.floor(60.0 * frame_rate / 180.0))
+    lag_max = int(np.ceil(60.0 * frame_rate / 60.0))
+    if len(onset_env) <= lag_max:
+        return 120.0
+
+    # Autocorrelation via the power spectrum (Wiener–Khinchin), O(N log N);
+    # zero-padding to 2N keeps it linear rather than circular
+    spectrum = sp_fft.rfft(onset_env, n=2 * len(onset_env))
+    ac = sp_fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2)
+    window = ac[lag_min : lag_max + 1]
+    peaks, _ = find_peaks(window)
+    best = peaks[np.argmax(window[peaks])] if len(peaks) else int(np.argmax(window))
+    return float(60.0 * frame_rate / (lag_min + best))
@@ -0,0 +1,96 @@
+"""Musica — Shared audio buffer helpers."""
+
+from __future__ import annotations
+
+import math
+import struct
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+from scipy.signal import resample_poly
+
+try:
+    from numba import njit
+    _HAVE_NUMBA = True
+except ImportError:  # to_wav_pcm16 uses its NumPy path instead
+    _HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):  # type: ignore[no-redef]
+        def decorate(fn):
+            return fn
+        return decorate
+
+
+def to_mono(audio: np.ndarray) -> np.ndarray:
+    """Down-mix ``(samples, channels)`` audio to a float32 mono signal.
+
+    Mono input is returned unchanged.
+    """
+    if audio.ndim == 1:
+        return audio
+    mono = np.add.reduce(audio, axis=1, dtype=np.float32)
+    mono *= np.float32(1.0 / audio.shape[1])
+    return mono
+
+
+def resample(audio: np.ndarray, sr: int, target_sr: int) -> np.ndarray:
+    """Polyphase-resample mono *audio* from *sr* to *target_sr* as float32."""
+    if sr == target_sr:
+        return audio
+    g = gcd(target_sr, sr)
+    return resample_poly(audio, target_sr // g, sr // g).astype(np.float32, copy=False)
+
+
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+WAV_HEADER_SIZE = WAV_HEADER.size  # 44 bytes
+
+
+@lru_cache(maxsize=8)
+def wav_header_template(sr: int) -> bytes:
+    """RIFF header for mono 16-bit PCM at *sr* with zeroed size fields."""
+    return WAV_HEADER.pack(
+        b"RIFF", 0, b"WAVE",
+        b"fmt ", 16, 1, 1, sr, sr * 2, 2, 16,
+        b"data", 0,
+    )
+
+
+def to_wav_pcm16(audio: np.ndarray, sr: int, gain: float = 1.0) -> bytearray:
+    """Encode mono float *audio* in [-1, 1] as a 16-bit PCM WAV file.
+
+    Samples are multiplied by *gain*, scaled by 2**15, floored and clipped,
+    as libsndfile does for PCM_16, and written straight into the output
+    buffer.
+    """
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    data_size = audio.size * 2
+    buf = bytearray(WAV_HEADER_SIZE + data_size)
+    buf[:WAV_HEADER_SIZE] = wav_header_template(sr)
+    struct.pack_into("<I", buf, 4, 36 + data_size)
+    struct.pack_into("<I", buf, 40, data_size)
+    out = np.frombuffer(buf, dtype="<i2", count=audio.size, offset=WAV_HEADER_SIZE)
+
+    scale = np.float32(gain * 32768.0)
+    if _HAVE_NUMBA and out.dtype.isnative:
+        _float_to_pcm16(audio, scale, out)
+    else:
+        pcm = np.multiply(audio, scale, dtype=np.float32)
+        np.floor(pcm, out=pcm)
+        np.clip(pcm, -32768, 32767, out=pcm)
+        np.copyto(out, pcm, casting="unsafe")
+    return buf
+
+
+# Explicit signature: compiled (or loaded from cache) at import, not on the
+# first recognition
+@njit("void(float32[::1], float32, int16[::1])", cache=True)
+def _float_to_pcm16(audio, scale, out):
+    """Scale, floor, clip and cast to int16 in one pass, without temporaries."""
+    for i in range(audio.size):
+        v = math.floor(audio[i] * scale)
+        if v > 32767:
+            v = 32767
+        elif v < -32768:
+            v = -32768
+        out[i] = v
@@ -13,11 +13,14 @@ except ImportError:
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATABASE_PATH = os.getenv("MUSICA_DB", str(BASE_DIR / "musica.db"))
 SONGS_DIR = os.getenv("MUSICA_SONGS_DIR", str(BASE_DIR / "songs"))
+DECODE_CACHE_DIR = os.getenv("MUSICA_DECODE_CACHE", str(Path(SONGS_DIR) / ".decoded"))
+DECODE_CACHE_MAX_MB = int(os.getenv("MUSICA_DECODE_CACHE_MB", "2048"))  # 0 disables the cache
 
 # ── Audio Processing ─────────────────────────────────────────────────────────
-SAMPLE_RATE = 22050          # Target sample rate for fingerprinting
-FFT_SIZE = 4096              # FFT window size
-HOP_LENGTH = 2048            # STFT hop length (50% overlap)
+SAMPLE_RATE = 22050          # Sample rate audio is loaded at
+FINGERPRINT_SAMPLE_RATE = 11025  # Fingerprints only use content below ~5.5 kHz
+FFT_SIZE = 2048              # FFT window size (~186 ms at 11025 Hz)
+HOP_LENGTH = 1024            # STFT hop length (50% overlap)
 PEAK_NEIGHBORHOOD = 20       # Local-max filter size (freq × time)
 AMPLITUDE_THRESHOLD = -60    # dB threshold for peak detection
 
@@ -30,7 +33,10 @@ MAX_TIME_DELTA = 200         # Maximum frame delta between paired peaks
 RECOGNITION_WINDOW = 8       # Seconds of audio needed before first attempt
 RECOGNITION_INTERVAL = 3     # Seconds between successive recognition attempts
 MIN_MATCH_THRESHOLD = 8      # Minimum aligned hashes for a valid match
+MAX_CANDIDATE_SONGS = 50     # Songs with the most hash hits kept for scoring
+MEMORY_INDEX = os.getenv("MUSICA_MEMORY_INDEX", "1") != "0"  # Match from RAM, not SQLite
 MAX_LISTEN_DURATION = 35     # Maximum seconds before giving up
+FINGERPRINT_WORKERS = int(os.getenv("MUSICA_FP_WORKERS", str(os.cpu_count() or 1)))  # total, across server workers
 
 # ── AI Analysis ──────────────────────────────────────────────────────────────
 LLM_API_KEY = os.getenv("MUSICA_LLM_API_KEY", "")       # OpenAI / compatible key
@@ -44,6 +50,11 @@ LLM_MODEL = os.getenv("MUSICA_LLM_MODEL", "gpt-4o-mini")
 # ── Server ───────────────────────────────────────────────────────────────────
 HOST = os.getenv("MUSICA_HOST", "0.0.0.0")
 PORT = int(os.getenv("MUSICA_PORT", "8000"))
+DEV = os.getenv("MUSICA_DEV", "").lower() in ("1", "true", "yes")  # auto-reload, one process
+WORKERS = int(os.getenv("MUSICA_WORKERS", str(os.cpu_count() or 1)))  # ignored in dev mode
+# Each server worker gets its share of the fingerprinting processes, so the
+# defaults add up to one of each per core rather than cores²
+SERVER_FP_WORKERS = max(1, FINGERPRINT_WORKERS // (1 if DEV else WORKERS))
 CORS_ORIGINS = os.getenv(
     "MUSICA_CORS_ORIGINS",
     "http://localhost:3000,http://localhost:5173",
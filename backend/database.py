@@ -1,9 +1,15 @@
 from __future__ import annotations
 
 import sqlite3
-from typing import Any
+import threading
+from contextlib import contextmanager
+from itertools import repeat
+from pathlib import Path
+from typing import Any, Iterable, Iterator
 
-from backend.config import DATABASE_PATH
+import numpy as np
+
+from backend.config import DATABASE_PATH, MEMORY_INDEX
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS songs (
@@ -20,26 +26,170 @@ CREATE TABLE IF NOT EXISTS songs (
 CREATE TABLE IF NOT EXISTS fingerprints (
     id          INTEGER PRIMARY KEY AUTOINCREMENT,
     song_id     INTEGER NOT NULL,
-    hash        TEXT    NOT NULL,
+    hash        INTEGER NOT NULL,
     time_offset INTEGER NOT NULL,
     FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
 );
 
-CREATE INDEX IF NOT EXISTS idx_fp_hash ON fingerprints(hash);
+-- Covering index: hash lookups are answered from the index alone
+CREATE INDEX IF NOT EXISTS idx_fp_hash ON fingerprints(hash, song_id, time_offset);
 """
 
+# Bumped whenever fingerprints become incompatible (stored in PRAGMA user_version)
+FINGERPRINT_VERSION = 2
+
+# Per-connection scratch table holding the hashes of the current query
+_TEMP_SCHEMA = "CREATE TEMP TABLE IF NOT EXISTS query_hashes (hash INTEGER PRIMARY KEY)"
+
+# Statement text is kept in constants so every call hands SQLite the same
+# string and hits its compiled-statement cache.
+_SQL_INSERT_SONG = (
+    "INSERT OR IGNORE INTO songs "
+    "(title, artist, album, duration, file_hash, artwork_url) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+_SQL_SONG_ID_BY_HASH = "SELECT id FROM songs WHERE file_hash = ?"
+_SQL_GET_SONG = (
+    "SELECT id, title, artist, album, duration, file_hash, artwork_url, created_at "
+    "FROM songs WHERE id = ?"
+)
+_SQL_ALL_SONGS = (
+    "SELECT id, title, artist, album, duration, artwork_url "
+    "FROM songs ORDER BY created_at DESC"
+)
+_SQL_SONG_EXISTS = "SELECT 1 FROM songs WHERE file_hash = ?"
+_SQL_EXISTING_HASHES = "SELECT file_hash FROM songs WHERE file_hash IN ({})"
+_EXISTS_BATCH = 500  # stays under SQLite's bound-parameter limit on old builds
+_SQL_DELETE_FINGERPRINTS = "DELETE FROM fingerprints WHERE song_id = ?"
+_SQL_DELETE_SONG = "DELETE FROM songs WHERE id = ?"
+_SQL_INSERT_FINGERPRINT = "INSERT INTO fingerprints (song_id, hash, time_offset) VALUES (?, ?, ?)"
+_SQL_CLEAR_QUERY = "DELETE FROM temp.query_hashes"
+_SQL_INSERT_QUERY = "INSERT OR IGNORE INTO temp.query_hashes (hash) VALUES (?)"
+# CROSS JOIN pins the query table as the outer loop of the index lookup
+_SQL_MATCHES = (
+    "SELECT f.hash, f.song_id, f.time_offset "
+    "FROM temp.query_hashes q CROSS JOIN fingerprints f ON f.hash = q.hash"
+)
+_SQL_TOP_SONGS = (
+    "SELECT f.song_id FROM temp.query_hashes q CROSS JOIN fingerprints f "
+    "ON f.hash = q.hash GROUP BY f.song_id ORDER BY COUNT(*) DESC LIMIT ?"
+)
+_SQL_ALL_FINGERPRINTS = "SELECT hash, song_id, time_offset FROM fingerprints ORDER BY hash"
+_SQL_COUNT_SONGS = "SELECT COUNT(*) FROM songs"
+_SQL_COUNT_FINGERPRINTS = "SELECT COUNT(*) FROM fingerprints"
+
+_INDEX_BATCH = 1 << 20  # rows fetched per step while loading the memory index
+
+# (hashes, song_ids, time_offsets), sorted by hash
+HashIndex = tuple[np.ndarray, np.ndarray, np.ndarray]
+
 
 class Database:
-    """Thin wrapper around a single SQLite connection."""
+    """Thin wrapper around SQLite.
+
+    Writes go through one shared connection guarded by a lock. Reads use a
+    read-only connection per thread, so concurrent recognitions can run
+    ``get_matches`` in parallel with each other and with the writer.
+
+    With ``MEMORY_INDEX`` on, ``get_matches`` answers from hash-sorted NumPy
+    copies of the fingerprint table instead. They are loaded on first use
+    and patched in place by this object's writes. After a commit (e.g. by
+    ``ingest.py``), a background thread reloads them while lookups keep
+    using the previous copy.
+    """
 
     def __init__(self, db_path: str | None = None) -> None:
         self.db_path = db_path or DATABASE_PATH
         self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._write_lock = threading.RLock()
+        self._batching = False
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        # Guards the index state and its connection, never held across a write,
+        # so lookups don't queue behind a batch holding the write lock
+        self._index_lock = threading.Lock()
+        self._index_conn: sqlite3.Connection | None = None
+        self._index: HashIndex | None = None
+        self._index_version: int = -1
+        # Own writes made while a background reload runs, replayed onto its result
+        self._index_log: list[tuple[int, np.ndarray | None, np.ndarray | None]] | None = None
         self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")      # safe with WAL
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA mmap_size=268435456")     # 256 MB
+        self.conn.execute("PRAGMA cache_size=-65536")       # 64 MB
+        self.conn.execute("PRAGMA wal_autocheckpoint=10000")
         self.conn.execute("PRAGMA foreign_keys=ON")
+        self._check_legacy_schema()
         self.conn.executescript(SCHEMA)
+        self.conn.execute(f"PRAGMA user_version={FINGERPRINT_VERSION}")
         self.conn.commit()
 
+    def _check_legacy_schema(self) -> None:
+        """Refuse to open databases holding fingerprints from an older version."""
+        columns = {row[1]: row[2] for row in self.conn.execute("PRAGMA table_info(fingerprints)")}
+        if columns.get("hash", "INTEGER").upper() != "INTEGER":
+            raise RuntimeError(
+                f"{self.db_path} stores fingerprint hashes as TEXT; "
+                "delete it and re-run ingest.py to rebuild the index"
+            )
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if columns and version != FINGERPRINT_VERSION:
+            if self.conn.execute("SELECT 1 FROM fingerprints LIMIT 1").fetchone():
+                raise RuntimeError(
+                    f"{self.db_path} holds fingerprints from an older version; "
+                    "delete it and re-run ingest.py to rebuild the index"
+                )
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run several writes as one transaction, paying for a single commit.
+
+        Writes made inside the block join it instead of committing on their
+        own; everything is rolled back if the block raises.
+        """
+        with self._write_lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._batching = True
+            try:
+                yield
+            except BaseException:
+                self.conn.rollback()
+                with self._index_lock:
+                    self._index = None  # may hold rolled-back rows; reload on next use
+                raise
+            else:
+                self.conn.commit()
+            finally:
+                self._batching = False
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """Hold the write lock inside a transaction, joining an open batch if any."""
+        with self._write_lock:
+            if self._batching:
+                yield
+            else:
+                with self.conn:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                    yield
+
+    def _reader(self) -> sqlite3.Connection:
+        """Return this thread's read-only connection, opening it on first use."""
+        conn: sqlite3.Connection | None = getattr(self._local, "conn", None)
+        if conn is None:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA cache_size=-65536")
+            conn.execute(_TEMP_SCHEMA)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
     # ── Songs ────────────────────────────────────────────────────────────
 
     def add_song(
@@ -51,26 +201,18 @@ class Database:
         file_hash: str = "",
         artwork_url: str = "",
     ) -> int | None:
-        cursor = self.conn.execute(
-            "INSERT OR IGNORE INTO songs "
-            "(title, artist, album, duration, file_hash, artwork_url) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (title, artist, album, duration, file_hash, artwork_url),
-        )
-        self.conn.commit()
-        if cursor.lastrowid:
-            return cursor.lastrowid
-        row = self.conn.execute(
-            "SELECT id FROM songs WHERE file_hash = ?", (file_hash,)
-        ).fetchone()
+        with self._writing():
+            cursor = self.conn.execute(
+                _SQL_INSERT_SONG,
+                (title, artist, album, duration, file_hash, artwork_url),
+            )
+            if cursor.rowcount:
+                return cursor.lastrowid
+            row = self.conn.execute(_SQL_SONG_ID_BY_HASH, (file_hash,)).fetchone()
         return row[0] if row else None
 
     def get_song(self, song_id: int) -> dict[str, Any] | None:
-        row = self.conn.execute(
-            "SELECT id, title, artist, album, duration, file_hash, artwork_url, created_at "
-            "FROM songs WHERE id = ?",
-            (song_id,),
-        ).fetchone()
+        row = self._reader().execute(_SQL_GET_SONG, (song_id,)).fetchone()
         if row:
             return dict(
                 id=row[0],
@@ -85,53 +227,233 @@ class Database:
         return None
 
     def get_all_songs(self) -> list[dict[str, Any]]:
-        rows = self.conn.execute(
-            "SELECT id, title, artist, album, duration, artwork_url "
-            "FROM songs ORDER BY created_at DESC"
-        ).fetchall()
+        rows = self._reader().execute(_SQL_ALL_SONGS).fetchall()
         return [
             dict(id=r[0], title=r[1], artist=r[2], album=r[3], duration=r[4], artwork_url=r[5])
             for r in rows
         ]
 
     def song_exists(self, file_hash: str) -> bool:
-        row = self.conn.execute(
-            "SELECT 1 FROM songs WHERE file_hash = ?", (file_hash,)
-        ).fetchone()
+        row = self._reader().execute(_SQL_SONG_EXISTS, (file_hash,)).fetchone()
         return row is not None
 
+    def songs_exist_bulk(self, file_hashes: Iterable[str]) -> set[str]:
+        """Return the subset of *file_hashes* already indexed, in a few queries."""
+        hashes = list(dict.fromkeys(file_hashes))
+        conn = self._reader()
+        found: set[str] = set()
+        for i in range(0, len(hashes), _EXISTS_BATCH):
+            chunk = hashes[i:i + _EXISTS_BATCH]
+            sql = _SQL_EXISTING_HASHES.format(",".join("?" * len(chunk)))
+            found.update(row[0] for row in conn.execute(sql, chunk))
+        return found
+
     def delete_song(self, song_id: int) -> None:
-        self.conn.execute("DELETE FROM fingerprints WHERE song_id = ?", (song_id,))
-        self.conn.execute("DELETE FROM songs WHERE id = ?", (song_id,))
-        self.conn.commit()
+        with self._writing():
+            self.conn.execute(_SQL_DELETE_FINGERPRINTS, (song_id,))
+            self.conn.execute(_SQL_DELETE_SONG, (song_id,))
+        with self._index_lock:
+            if self._index is not None:
+                self._index = _index_drop(self._index, song_id)
+            if self._index_log is not None:
+                self._index_log.append((song_id, None, None))
 
     # ── Fingerprints ─────────────────────────────────────────────────────
 
-    def add_fingerprints(self, song_id: int, fingerprints: list[tuple[str, int]]) -> None:
-        """Store a batch of (hash, time_offset) fingerprints for a song."""
-        self.conn.executemany(
-            "INSERT INTO fingerprints (song_id, hash, time_offset) VALUES (?, ?, ?)",
-            [(song_id, h, o) for h, o in fingerprints],
-        )
-        self.conn.commit()
+    def add_fingerprints(self, song_id: int, hashes: np.ndarray, offsets: np.ndarray) -> None:
+        """Store parallel *hashes* / *offsets* arrays for a song in one transaction."""
+        with self._write_lock:
+            with self._writing():
+                self.conn.executemany(
+                    _SQL_INSERT_FINGERPRINT,
+                    zip(repeat(song_id), hashes.tolist(), offsets.tolist()),
+                )
+            self._index_insert(song_id, hashes, offsets)
 
-    def get_matches(self, hash_values: list[str]) -> list[tuple[str, int, int]]:
-        """Look up hashes. Returns [(hash, song_id, time_offset), ...]."""
-        if not hash_values:
-            return []
-        placeholders = ",".join(["?"] * len(hash_values))
-        return self.conn.execute(
-            f"SELECT hash, song_id, time_offset FROM fingerprints "
-            f"WHERE hash IN ({placeholders})",
-            hash_values,
-        ).fetchall()
+    def add_song_with_fingerprints(
+        self,
+        title: str,
+        artist: str,
+        album: str,
+        duration: float,
+        file_hash: str,
+        hashes: np.ndarray,
+        offsets: np.ndarray,
+        artwork_url: str = "",
+    ) -> int | None:
+        """Insert a song and its *hashes* / *offsets* fingerprints in one transaction.
+
+        Returns the new song id. If a song with *file_hash* already exists its
+        id is returned and no fingerprints are added.
+        """
+        with self._write_lock:
+            with self._writing():
+                cursor = self.conn.execute(
+                    _SQL_INSERT_SONG,
+                    (title, artist, album, duration, file_hash, artwork_url),
+                )
+                if not cursor.rowcount:
+                    row = self.conn.execute(_SQL_SONG_ID_BY_HASH, (file_hash,)).fetchone()
+                    return row[0] if row else None
+                song_id = cursor.lastrowid
+                self.conn.executemany(
+                    _SQL_INSERT_FINGERPRINT,
+                    zip(repeat(song_id), hashes.tolist(), offsets.tolist()),
+                )
+            self._index_insert(song_id, hashes, offsets)
+        return song_id
+
+    def get_matches(
+        self, hash_values: Iterable[int], max_songs: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Look up hashes. Returns int64 arrays ``(hashes, song_ids, time_offsets)``.
+
+        The hashes are loaded into a temp table and joined against the
+        fingerprint index, so any number of hashes runs as one statement.
+        With *max_songs*, only rows for the songs with the most hash hits
+        are returned; the counting happens inside SQLite.
+        """
+        index = self.memory_index()
+        if index is not None:
+            return _search_index(index, hash_values, max_songs)
+
+        conn = self._reader()
+        with conn:
+            conn.execute(_SQL_CLEAR_QUERY)
+            conn.executemany(_SQL_INSERT_QUERY, ((h,) for h in hash_values))
+            if max_songs is None:
+                rows = conn.execute(_SQL_MATCHES).fetchall()
+            else:
+                top = [r[0] for r in conn.execute(_SQL_TOP_SONGS, (max_songs,))]
+                sql = f"{_SQL_MATCHES} WHERE f.song_id IN ({','.join('?' * len(top))})"
+                rows = conn.execute(sql, top).fetchall() if top else []
+        cols = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return cols[:, 0], cols[:, 1], cols[:, 2]
+
+    # ── In-memory hash index ─────────────────────────────────────────────
+
+    def memory_index(self) -> HashIndex | None:
+        """Return the in-memory hash index, loading it on first use.
+
+        ``PRAGMA data_version`` is read on a dedicated read-only connection,
+        so a batch holding the write lock never blocks lookups. It moves on
+        every commit by another connection (our writer included). When it
+        does, the current index is returned and a fresh one is built in a
+        background thread, so a bulk ingest committing every few songs never
+        stalls recognitions behind a full table read.
+        """
+        if not MEMORY_INDEX:
+            return None
+        with self._index_lock:
+            if self._index_conn is None:
+                uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+                self._index_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            version = self._index_conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._index is None:
+                self._index = self._load_index(self._index_conn)
+                self._index_version = version
+            elif version != self._index_version and self._index_log is None:
+                self._index_log = []
+                threading.Thread(
+                    target=self._reload_index, args=(version,), name="musica-index", daemon=True
+                ).start()
+            return self._index
+
+    def _reload_index(self, version: int) -> None:
+        """Background half of :meth:`memory_index`: load, replay own writes, swap."""
+        try:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True)
+            try:
+                index: HashIndex | None = self._load_index(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error as exc:
+            print(f"[database] Index reload failed: {exc}")
+            index = None
+        with self._index_lock:
+            if index is not None and self._index is not None:
+                for song_id, hashes, offsets in self._index_log or ():
+                    if hashes is None:
+                        index = _index_drop(index, song_id)
+                    elif not (index[1] == song_id).any():  # not already in the snapshot
+                        index = _index_merge(index, song_id, hashes, offsets)
+                self._index = index
+                self._index_version = version  # a commit since then triggers another reload
+            self._index_log = None
+
+    @staticmethod
+    def _load_index(conn: sqlite3.Connection) -> HashIndex:
+        cursor = conn.execute(_SQL_ALL_FINGERPRINTS)
+        chunks = [np.empty((0, 3), dtype=np.int64)]
+        while rows := cursor.fetchmany(_INDEX_BATCH):
+            chunks.append(np.array(rows, dtype=np.int64))
+        table = np.concatenate(chunks)
+        return table[:, 0].copy(), table[:, 1].astype(np.int32), table[:, 2].astype(np.int32)
+
+    def _index_insert(self, song_id: int, new_hashes: np.ndarray, new_offsets: np.ndarray) -> None:
+        """Merge a committed song's fingerprints into the loaded index."""
+        with self._index_lock:
+            if self._index is None or not len(new_hashes):
+                return
+            self._index = _index_merge(self._index, song_id, new_hashes, new_offsets)
+            if self._index_log is not None:
+                self._index_log.append((song_id, new_hashes, new_offsets))
 
     # ── Stats ────────────────────────────────────────────────────────────
 
     def get_stats(self) -> dict[str, int]:
-        songs = self.conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
-        fps = self.conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+        conn = self._reader()
+        songs = conn.execute(_SQL_COUNT_SONGS).fetchone()[0]
+        fps = conn.execute(_SQL_COUNT_FINGERPRINTS).fetchone()[0]
         return {"songs": songs, "fingerprints": fps}
 
     def close(self) -> None:
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+        with self._index_lock:
+            if self._index_conn is not None:
+                self._index_conn.close()
+        self.conn.execute("PRAGMA optimize")
         self.conn.close()
+
+
+def _index_merge(
+    index: HashIndex, song_id: int, new_hashes: np.ndarray, new_offsets: np.ndarray
+) -> HashIndex:
+    """Return *index* with one song's fingerprints inserted in hash order."""
+    order = np.argsort(new_hashes, kind="stable")
+    new_hashes = np.asarray(new_hashes, dtype=np.int64)[order]
+    hashes, song_ids, offsets = index
+    at = np.searchsorted(hashes, new_hashes, side="right")
+    return (
+        np.insert(hashes, at, new_hashes),
+        np.insert(song_ids, at, song_id),
+        np.insert(offsets, at, np.asarray(new_offsets)[order]),
+    )
+
+
+def _index_drop(index: HashIndex, song_id: int) -> HashIndex:
+    """Return *index* without *song_id*'s rows."""
+    keep = index[1] != song_id
+    return tuple(col[keep] for col in index)  # type: ignore[return-value]
+
+
+def _search_index(
+    index: HashIndex, hash_values: Iterable[int], max_songs: int | None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """``get_matches`` over the in-memory index via binary search."""
+    hashes, song_ids, offsets = index
+    query = np.unique(np.fromiter(hash_values, dtype=np.int64))
+    lo = np.searchsorted(hashes, query, side="left")
+    n = np.searchsorted(hashes, query, side="right") - lo
+    # Concatenate the [lo, lo + n) runs into one row-index array
+    rows = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())
+    if max_songs is not None:
+        songs, hits = np.unique(song_ids[rows], return_counts=True)
+        if len(songs) > max_songs:
+            top = songs[np.argpartition(hits, -max_songs)[-max_songs:]]
+            rows = rows[np.isin(song_ids[rows], top)]
+    return hashes[rows], song_ids[rows].astype(np.int64), offsets[rows].astype(np.int64)
@@ -1,18 +1,33 @@
 from __future__ import annotations
 
-import hashlib
-from collections import Counter, defaultdict
-from typing import TYPE_CHECKING
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable
 
-import librosa
 import numpy as np
-from scipy.ndimage import maximum_filter
+from scipy import fft as sp_fft
+from scipy.ndimage import maximum_filter1d
+from scipy.signal.windows import hann
 
+try:
+    from numba import njit
+    _HAVE_NUMBA = True
+except ImportError:  # kernels stay plain Python; NumPy/SciPy fallbacks are used instead
+    _HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):  # type: ignore[no-redef]
+        def decorate(fn):
+            return fn
+        return decorate
+
+from backend.audio import resample, to_mono
 from backend.config import (
     AMPLITUDE_THRESHOLD,
     FAN_OUT,
     FFT_SIZE,
+    FINGERPRINT_SAMPLE_RATE,
     HOP_LENGTH,
+    MAX_CANDIDATE_SONGS,
     MAX_TIME_DELTA,
     MIN_MATCH_THRESHOLD,
     MIN_TIME_DELTA,
@@ -23,117 +38,311 @@ from backend.config import (
 if TYPE_CHECKING:
     from backend.database import Database
 
+# Parallel (hashes int64, time_offsets int32) arrays
+Fingerprints = tuple[np.ndarray, np.ndarray]
+
 
 # ── Public API ───────────────────────────────────────────────────────────────
 
 def generate_fingerprints(
     audio: np.ndarray,
     sr: int = SAMPLE_RATE,
-) -> list[tuple[str, int]]:
-    """Return a list of (hash_hex, time_offset) fingerprints for *audio*."""
+) -> Fingerprints:
+    """Return ``(hashes, time_offsets)`` fingerprint arrays for *audio*."""
     if len(audio) < sr:  # less than 1 second — too short
-        return []
+        return _no_fingerprints()
 
-    # Mono / resample
-    if audio.ndim > 1:
-        audio = np.mean(audio, axis=1)
-    if sr != SAMPLE_RATE:
-        audio = librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE)
+    # Mono / resample (float32 end to end)
+    audio = to_mono(np.asarray(audio, dtype=np.float32))
+    audio = resample(audio, sr, FINGERPRINT_SAMPLE_RATE)
 
     # STFT → magnitude spectrogram (dB)
-    S = np.abs(librosa.stft(audio, n_fft=FFT_SIZE, hop_length=HOP_LENGTH))
-    S_db = librosa.amplitude_to_db(S, ref=np.max)
+    S_db = _spectrogram_db(audio)
 
     # Find spectral peaks
-    peaks = _find_peaks(S_db)
-    if len(peaks) < 2:
-        return []
+    freqs, times = _find_peaks(S_db)
+    if len(freqs) < 2:
+        return _no_fingerprints()
 
     # Generate combinatorial hashes from peak pairs
-    return _hash_peaks(peaks)
+    return _hash_peaks(freqs, times)
 
 
 def find_match(
-    query_fps: list[tuple[str, int]],
+    query_fps: Fingerprints,
     db: "Database",
 ) -> tuple[int | None, float]:
     """Match *query_fps* against the database.
 
     Returns ``(song_id, confidence)`` or ``(None, 0.0)``.
     """
-    if not query_fps:
+    hashes, offsets = query_fps
+    if not len(hashes):
         return None, 0.0
 
-    # Build hash → [query_offset, …] map
-    h2q: dict[str, list[int]] = defaultdict(list)
-    for h, off in query_fps:
-        h2q[h].append(off)
+    # Query fingerprints sorted by hash, so each hash owns a contiguous run
+    order = np.argsort(hashes, kind="stable")
+    q_hashes, q_offsets = hashes[order], offsets[order].astype(np.int64)
 
-    unique_hashes = list(h2q.keys())
+    db_hashes, song_ids, db_offsets = db.get_matches(
+        np.unique(q_hashes).tolist(), max_songs=MAX_CANDIDATE_SONGS
+    )
 
-    # Batch DB lookups (SQLite has a 999-variable limit)
-    BATCH = 900
-    db_rows: list[tuple[str, int, int]] = []
-    for i in range(0, len(unique_hashes), BATCH):
-        db_rows.extend(db.get_matches(unique_hashes[i : i + BATCH]))
-
-    if not db_rows:
+    if not len(db_hashes):
         return None, 0.0
 
-    # Accumulate offset-deltas per song
-    song_deltas: dict[int, list[int]] = defaultdict(list)
-    for db_hash, song_id, db_offset in db_rows:
-        for q_off in h2q[db_hash]:
-            song_deltas[song_id].append(db_offset - q_off)
-
-    # Find the song whose delta histogram has the tallest peak
-    best_id: int | None = None
-    best_count = 0
-    for song_id, deltas in song_deltas.items():
-        top_count = Counter(deltas).most_common(1)[0][1]
-        if top_count > best_count:
-            best_count = top_count
-            best_id = song_id
-
-    if best_id is not None and best_count >= MIN_MATCH_THRESHOLD:
+    # Pair every DB row with each query offset sharing its hash
+    lo = np.searchsorted(q_hashes, db_hashes, side="left")
+    per_row = np.searchsorted(q_hashes, db_hashes, side="right") - lo
+    rows = np.repeat(np.arange(len(db_hashes)), per_row)
+    run_start = np.cumsum(per_row) - per_row
+    q_idx = lo[rows] + np.arange(len(rows)) - run_start[rows]
+    deltas = db_offsets[rows] - q_offsets[q_idx]
+
+    # One flat histogram: a row of delta bins per candidate song
+    songs, song_idx = np.unique(song_ids[rows], return_inverse=True)
+    d_min = deltas.min()
+    span = int(deltas.max() - d_min) + 1
+    hist = np.bincount(song_idx * span + (deltas - d_min))
+    top = int(np.argmax(hist))
+    best_id, best_count = int(songs[top // span]), int(hist[top])
+
+    if best_count >= MIN_MATCH_THRESHOLD:
         confidence = min(100.0, best_count * 2.0)
         return best_id, confidence
 
     return None, 0.0
 
 
+def init_pool_worker() -> None:
+    """``ProcessPoolExecutor`` initializer: fingerprint on a single thread.
+
+    The pool already runs one process per core, so multi-threaded FFTs
+    inside each worker would only oversubscribe the CPUs.
+    """
+    global _fft_workers
+    _fft_workers = 1
+
+
 # ── Internal helpers ─────────────────────────────────────────────────────────
 
+_STFT_TILE = 256  # frames per rfft batch, keeps each tile's buffers in cache
+_fft_workers = -1  # rfft threads per call: all cores, or 1 inside a worker pool
+_HANN = hann(FFT_SIZE, sym=False).astype(np.float32)  # periodic, as librosa uses
+_filter_scratch = threading.local()  # per-thread output for the SciPy peak path
+
+
+def _spectrogram_db(audio: np.ndarray) -> np.ndarray:
+    """Return ``|STFT|`` in dB relative to the loudest bin, shaped (freq, time).
+
+    Frames match ``librosa.stft`` (centred, zero padded, Hann window). The
+    FFT runs in tiles of frames written straight into one float32 buffer,
+    which is then converted to dB in place.
+    """
+    padded = np.pad(audio, FFT_SIZE // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, FFT_SIZE)[::HOP_LENGTH]
+
+    S = np.empty((len(frames), FFT_SIZE // 2 + 1), dtype=np.float32)
+    for start in range(0, len(frames), _STFT_TILE):
+        stop = min(start + _STFT_TILE, len(frames))
+        spectrum = sp_fft.rfft(frames[start:stop] * _HANN, axis=-1, workers=_fft_workers)
+        np.abs(spectrum, out=S[start:stop])
+
+    ref = max(float(S.max()), 1e-10)
+    np.maximum(S, 1e-10, out=S)
+    np.log10(S, out=S)
+    S *= 20.0
+    S -= 20.0 * np.log10(ref)
+    return S.T
+
+
 def _find_peaks(
     spectrogram: np.ndarray,
     neighborhood: int = PEAK_NEIGHBORHOOD,
     threshold: float = AMPLITUDE_THRESHOLD,
-) -> list[tuple[int, int]]:
-    """Return ``[(freq_bin, time_frame), …]`` of spectral peaks."""
-    local_max = maximum_filter(spectrogram, size=neighborhood)
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return ``(freq_bins, time_frames)`` of spectral peaks, sorted by time.
+
+    Frequency bins come back as int16 (FFT_SIZE // 2 + 1 bins) and time
+    frames as int32.
+
+    A peak is a bin above *threshold* with no larger value in the
+    *neighborhood* × *neighborhood* window around it.
+    """
+    if _HAVE_NUMBA:
+        # Any memory layout works; the (time, freq) buffer from
+        # _spectrogram_db arrives transposed, keeping frequency scans contiguous
+        S = spectrogram
+        count_peaks, fill_peaks = _peak_kernels(neighborhood)
+        counts = count_peaks(S, threshold)
+        starts = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=starts[1:])
+        freq_idx = np.empty(starts[-1], dtype=np.int16)
+        time_idx = np.empty(starts[-1], dtype=np.int32)
+        fill_peaks(S, threshold, starts, freq_idx, time_idx)
+        return freq_idx, time_idx  # columns are filled in (time, freq) order
+
+    # Separable box max: frequency pass, then time pass in place. For a
+    # max filter, "nearest" edges equal -inf padding, since the edge bin
+    # is already inside every window that overhangs it.
+    local_max = _scratch(spectrogram.shape)
+    maximum_filter1d(spectrogram, neighborhood, axis=0, output=local_max, mode="nearest")
+    maximum_filter1d(local_max, neighborhood, axis=1, output=local_max, mode="nearest")
     mask = (spectrogram == local_max) & (spectrogram > threshold)
     freq_idx, time_idx = np.nonzero(mask)
     # Sort by time, then frequency
     order = np.lexsort((freq_idx, time_idx))
-    return list(zip(freq_idx[order].tolist(), time_idx[order].tolist()))
+    return freq_idx[order].astype(np.int16), time_idx[order].astype(np.int32)
+
+
+def _scratch(shape: tuple[int, ...]) -> np.ndarray:
+    """Return this thread's reusable float32 filter buffer for *shape*."""
+    buf: np.ndarray | None = getattr(_filter_scratch, "buf", None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.float32)
+        _filter_scratch.buf = buf
+    return buf
+
+
+@lru_cache(maxsize=None)
+def _peak_kernels(neighborhood: int) -> tuple[Callable, Callable]:
+    """Compile ``(count, fill)`` peak kernels for one window size.
+
+    The window offsets are closure constants, so Numba sees fixed trip
+    counts for interior bins and can unroll and vectorise the scan; only
+    bins within a window of the edge take the clamped path.
+
+    The kernels are serial and release the GIL. Callers parallelise across
+    processes or threads, and a Numba threading layer under them is neither
+    fork-safe (OpenMP) nor safe to enter from several threads (workqueue).
+    """
+    before = neighborhood // 2  # same placement as maximum_filter(size=neighborhood)
+    after = neighborhood - before - 1
+
+    @njit(cache=True, nogil=True, boundscheck=False)
+    def is_peak(S, f, t):
+        v = S[f, t]
+        n_freq, n_time = S.shape
+        if before <= f < n_freq - after and before <= t < n_time - after:
+            for ff in range(f - before, f + after + 1):
+                for tt in range(t - before, t + after + 1):
+                    if S[ff, tt] > v:
+                        return False
+            return True
+        for ff in range(max(f - before, 0), min(f + after + 1, n_freq)):
+            for tt in range(max(t - before, 0), min(t + after + 1, n_time)):
+                if S[ff, tt] > v:
+                    return False
+        return True
+
+    @njit(cache=True, nogil=True, boundscheck=False)
+    def count_peaks(S, thr):
+        """Pass 1: number of peaks in each time frame."""
+        n_freq, n_time = S.shape
+        counts = np.zeros(n_time, dtype=np.int64)
+        for t in range(n_time):
+            c = 0
+            for f in range(n_freq):
+                if S[f, t] > thr and is_peak(S, f, t):
+                    c += 1
+            counts[t] = c
+        return counts
+
+    @njit(cache=True, nogil=True, boundscheck=False)
+    def fill_peaks(S, thr, starts, out_f, out_t):
+        """Pass 2: write each frame's peaks at its offset from ``count_peaks``."""
+        n_freq, n_time = S.shape
+        for t in range(n_time):
+            k = starts[t]
+            for f in range(n_freq):
+                if S[f, t] > thr and is_peak(S, f, t):
+                    out_f[k] = f
+                    out_t[k] = t
+                    k += 1
+
+    return count_peaks, fill_peaks
+
+
+if _HAVE_NUMBA:
+    _peak_kernels(PEAK_NEIGHBORHOOD)  # the deployment's window, specialised up front
+
+
+def _no_fingerprints() -> Fingerprints:
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
 
 
 def _hash_peaks(
-    peaks: list[tuple[int, int]],
+    freqs: np.ndarray,
+    times: np.ndarray,
     fan_out: int = FAN_OUT,
-) -> list[tuple[str, int]]:
+) -> Fingerprints:
     """Pair each peak with its *fan_out* nearest future neighbours and hash."""
-    hashes: list[tuple[str, int]] = []
-    n = len(peaks)
+    return _pair_peaks(
+        freqs,
+        times,
+        fan_out,
+        MIN_TIME_DELTA,
+        MAX_TIME_DELTA,
+    )
+
+
+@njit(cache=True, boundscheck=False, fastmath=True)
+def _pair_peaks(
+    freqs: np.ndarray,
+    times: np.ndarray,
+    fan_out: int,
+    t_min: int,
+    t_max: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return ``(hashes, anchor_offsets)`` for time-sorted peak arrays.
+
+    Each hash packs ``(f1, f2, dt)`` losslessly into one non-negative
+    int64: ``f1 << 40 | f2 << 20 | dt`` (20 bits per field).
+    """
+    n = freqs.shape[0]
+    hashes = np.empty(n * fan_out, dtype=np.int64)
+    offsets = np.empty(n * fan_out, dtype=np.int32)
+    k = 0
     for i in range(n):
-        f1, t1 = peaks[i]
-        for j in range(1, fan_out + 1):
-            if i + j >= n:
-                break
-            f2, t2 = peaks[i + j]
-            dt = t2 - t1
-            if MIN_TIME_DELTA <= dt <= MAX_TIME_DELTA:
-                raw = f"{f1}|{f2}|{dt}".encode()
-                h = hashlib.sha1(raw).hexdigest()[:20]
-                hashes.append((h, t1))
-    return hashes
+        f1 = np.int64(freqs[i])
+        t1 = times[i]
+        for j in range(i + 1, min(i + fan_out + 1, n)):
+            dt = times[j] - t1
+            if dt > t_max:
+                break  # peaks are time-sorted — later ones are further away
+            if dt < t_min:
+                continue
+            hashes[k] = (f1 << 40) | (np.int64(freqs[j]) << 20) | np.int64(dt)
+            offsets[k] = t1
+            k += 1
+    return hashes[:k], offsets[:k]
+
+
+def _pair_peaks_numpy(
+    freqs: np.ndarray,
+    times: np.ndarray,
+    fan_out: int,
+    t_min: int,
+    t_max: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorised :func:`_pair_peaks` for when Numba is unavailable.
+
+    Instead of looping over anchors it loops over the *fan_out* pairing
+    distances, pairing every peak with the one ``j`` places later in a
+    single array expression. Output order differs; the pairs are the same.
+    """
+    f = freqs.astype(np.int64)
+    out_hashes: list[np.ndarray] = []
+    out_offsets: list[np.ndarray] = []
+    for j in range(1, min(fan_out, len(f) - 1) + 1):
+        dt = (times[j:] - times[:-j]).astype(np.int64)
+        keep = (dt >= t_min) & (dt <= t_max)
+        out_hashes.append(((f[:-j] << 40) | (f[j:] << 20) | dt)[keep])
+        out_offsets.append(times[:-j][keep])
+    if not out_hashes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+    return np.concatenate(out_hashes), np.concatenate(out_offsets).astype(np.int32)
+
+
+if not _HAVE_NUMBA:
+    _pair_peaks = _pair_peaks_numpy  # noqa: F811
@@ -3,11 +3,16 @@ from __future__ import annotations
 import asyncio
 import hashlib
 import json
+import multiprocessing
+import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
 
 import librosa
 import numpy as np
+import soundfile as sf
 from fastapi import FastAPI, File, Form, UploadFile, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
@@ -19,10 +24,12 @@ from backend.config import (
     RECOGNITION_INTERVAL,
     RECOGNITION_WINDOW,
     SAMPLE_RATE,
+    SERVER_FP_WORKERS,
 )
 from backend.analyzer import analyze_song
+from backend.audio import resample, to_mono
 from backend.database import Database
-from backend.fingerprint import find_match, generate_fingerprints
+from backend.fingerprint import Fingerprints, find_match, generate_fingerprints, init_pool_worker
 from backend.recognizer import recognize_with_ai, is_configured as ai_is_configured, get_provider_name
 from backend import acrcloud
 
@@ -39,12 +46,24 @@ app.add_middleware(
 )
 
 db: Database | None = None
+# STFT + peak picking + hashing run here, off the GIL; workers never touch SQLite
+_fp_pool: ProcessPoolExecutor | None = None
 
 
 @app.on_event("startup")
 async def startup() -> None:
-    global db
+    global db, _fp_pool
     db = Database()
+    # Spawned, not forked: the event loop and its helper threads already exist
+    # here, and a forked child could inherit a lock one of them was holding
+    _fp_pool = ProcessPoolExecutor(
+        max_workers=SERVER_FP_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_pool_worker,
+    )
+    # Start every worker now so the first recognitions don't pay the imports
+    await asyncio.to_thread(lambda: list(_fp_pool.map(int, range(SERVER_FP_WORKERS))))
+    await asyncio.to_thread(db.memory_index)  # load before the first recognition
     stats = db.get_stats()
     acr_status = "ACRCloud: ready" if acrcloud.is_configured() else "ACRCloud: not configured"
     ai_status = f"AI: {get_provider_name()}" if ai_is_configured() else "AI: not configured"
@@ -53,6 +72,8 @@ async def startup() -> None:
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    if _fp_pool:
+        _fp_pool.shutdown(cancel_futures=True)
     if db:
         db.close()
 
@@ -64,7 +85,8 @@ async def ws_recognize(ws: WebSocket) -> None:
     await ws.accept()
 
     client_sr: int = 44100
-    audio_chunks: list[np.ndarray] = []
+    buf: np.ndarray | None = None  # holds the last MAX_LISTEN_DURATION seconds
+    write: int = 0  # samples currently held in buf
     total_samples: int = 0
     last_process_at: float = 0.0  # duration (s) when we last ran recognition
     ai_called: bool = False  # Track if AI has been called (call only once)
@@ -91,8 +113,18 @@ async def ws_recognize(ws: WebSocket) -> None:
 
             # ── Binary message (PCM Float32 audio) ───────────────────────
             if "bytes" in msg:
-                chunk = np.frombuffer(msg["bytes"], dtype=np.float32).copy()
-                audio_chunks.append(chunk)
+                # Read-only view; the copy into buf below is the only one
+                chunk = np.frombuffer(msg["bytes"], dtype=np.float32)
+                if buf is None:  # allocated once the client's sample rate is known
+                    buf = np.empty(MAX_LISTEN_DURATION * client_sr, dtype=np.float32)
+                n = min(len(chunk), len(buf))
+                if write + n > len(buf):
+                    # Full — slide the newest audio down to make room
+                    keep = len(buf) - n
+                    np.copyto(buf[:keep], buf[write - keep:write])
+                    write = keep
+                buf[write:write + n] = chunk[len(chunk) - n:]
+                write += n
                 total_samples += len(chunk)
 
                 duration = total_samples / client_sr
@@ -120,10 +152,8 @@ async def ws_recognize(ws: WebSocket) -> None:
                 if should_try_acr:
                     last_process_at = duration
                     await ws.send_json({"status": "analyzing"})
-                    audio_all = np.concatenate(audio_chunks)
-                    result = await asyncio.to_thread(
-                        acrcloud.recognize, audio_all, client_sr
-                    )
+                    audio_all = buf[:write]
+                    result = await acrcloud.recognize_async(audio_all, client_sr)
                     if result:
                         ai_called = True
                         # Enrich with AI analysis if available
@@ -154,18 +184,37 @@ async def ws_recognize(ws: WebSocket) -> None:
             pass
 
 
+def _fingerprints(audio: np.ndarray, sr: int) -> Fingerprints:
+    """Synchronous helper — run ``generate_fingerprints`` in the worker pool."""
+    if _fp_pool is None:
+        return generate_fingerprints(audio, sr)
+    return _fp_pool.submit(generate_fingerprints, audio, sr).result()
+
+
+def _cache_prints(audio: np.ndarray, sr: int) -> Fingerprints | None:
+    """Fingerprints for the AI result cache, or None to skip the cache on failure."""
+    try:
+        return _fingerprints(audio, sr)
+    except Exception as e:
+        print(f"[main] Fingerprinting failed ({type(e).__name__}): {e}; skipping the AI cache")
+        return None
+
+
 def _recognize_audio(audio: np.ndarray, sr: int) -> dict | None:
     """Synchronous helper — AI recognition first, fingerprint fallback."""
 
     # ── Primary: AI recognition (identifies any song) ────────────────
+    fps = None
     if ai_is_configured():
-        result = recognize_with_ai(audio, sr)
+        fps = _cache_prints(audio, sr)
+        result = recognize_with_ai(audio, sr, fps)
         if result:
             return {"status": "match_found", **result}
 
     # ── Fallback: local fingerprint matching ─────────────────────────
-    fps = generate_fingerprints(audio, sr)
-    if not fps:
+    if fps is None:
+        fps = _fingerprints(audio, sr)
+    if not len(fps[0]):
         return None
     song_id, confidence = find_match(fps, db)  # type: ignore[arg-type]
     if song_id is None:
@@ -198,8 +247,8 @@ def _recognize_audio(audio: np.ndarray, sr: int) -> dict | None:
 
 def _recognize_audio_fingerprint_only(audio: np.ndarray, sr: int) -> dict | None:
     """Synchronous helper — fingerprint matching only (no AI calls)."""
-    fps = generate_fingerprints(audio, sr)
-    if not fps:
+    fps = _fingerprints(audio, sr)
+    if not len(fps[0]):
         return None
     song_id, confidence = find_match(fps, db)  # type: ignore[arg-type]
     if song_id is None:
@@ -221,9 +270,9 @@ def _recognize_audio_fingerprint_only(audio: np.ndarray, sr: int) -> dict | None
 
 def _recognize_audio_ai_only(audio: np.ndarray, sr: int) -> dict | None:
     """Synchronous helper — AI recognition only (called once as final attempt)."""
-    if not is_configured():
+    if not ai_is_configured():
         return None
-    result = recognize_with_ai(audio, sr)
+    result = recognize_with_ai(audio, sr, _cache_prints(audio, sr))
     if result:
         return {"status": "match_found", **result}
     return None
@@ -248,14 +297,44 @@ def _enrich_with_ai_analysis(result: dict, audio: np.ndarray, sr: int) -> dict |
 
 # ── REST: file upload recognition ────────────────────────────────────────────
 
+_UPLOAD_CHUNK = 1 << 20  # bytes per read when hashing / copying uploads
+
+
+def _load_upload(fileobj: BinaryIO, filename: str | None) -> tuple[np.ndarray, int]:
+    """Decode uploaded audio to mono float32 at ``SAMPLE_RATE``.
+
+    libsndfile reads WAV/FLAC/OGG (and MP3 on 1.1+) straight from the
+    upload's spooled file; anything it rejects is copied to a named temp
+    file for librosa's audioread fallback.
+    """
+    fileobj.seek(0)
+    try:
+        audio, sr = sf.read(fileobj, dtype="float32")
+    except RuntimeError:  # soundfile.LibsndfileError: unsupported format
+        fileobj.seek(0)
+        suffix = Path(filename or "audio.wav").suffix
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=True) as tmp:
+            shutil.copyfileobj(fileobj, tmp, _UPLOAD_CHUNK)
+            tmp.flush()
+            return librosa.load(tmp.name, sr=SAMPLE_RATE, mono=True)
+    return resample(to_mono(audio), sr, SAMPLE_RATE), SAMPLE_RATE
+
+
+def _md5_upload(fileobj: BinaryIO) -> str:
+    """MD5 of an upload, read in chunks rather than into one bytes object."""
+    fileobj.seek(0)
+    if hasattr(hashlib, "file_digest"):  # Python 3.11+: read loop runs in C
+        return hashlib.file_digest(fileobj, "md5").hexdigest()
+    digest = hashlib.md5()
+    while chunk := fileobj.read(_UPLOAD_CHUNK):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
 @app.post("/api/recognize")
 async def recognize_upload(file: UploadFile = File(...)) -> JSONResponse:
     """Upload an audio file and identify the song."""
-    suffix = Path(file.filename or "audio.wav").suffix
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=True) as tmp:
-        tmp.write(await file.read())
-        tmp.flush()
-        audio, sr = librosa.load(tmp.name, sr=SAMPLE_RATE, mono=True)
+    audio, sr = await asyncio.to_thread(_load_upload, file.file, file.filename)
 
     result = await asyncio.to_thread(_recognize_audio, audio, sr)
     if result:
@@ -273,30 +352,26 @@ async def add_song(
     album: str = Form(""),
 ) -> JSONResponse:
     """Add a new song to the fingerprint database."""
-    content = await file.read()
-    file_hash = hashlib.md5(content).hexdigest()
+    file_hash = await asyncio.to_thread(_md5_upload, file.file)
 
     if db.song_exists(file_hash):  # type: ignore[union-attr]
         return JSONResponse({"status": "exists", "message": "Song already indexed"}, status_code=409)
 
-    suffix = Path(file.filename or "audio.wav").suffix
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=True) as tmp:
-        tmp.write(content)
-        tmp.flush()
-        audio, sr = librosa.load(tmp.name, sr=SAMPLE_RATE, mono=True)
-
+    audio, sr = await asyncio.to_thread(_load_upload, file.file, file.filename)
     duration = float(len(audio) / sr)
-    song_id = db.add_song(title, artist, album, duration, file_hash)  # type: ignore[union-attr]
+    hashes, offsets = await asyncio.get_running_loop().run_in_executor(
+        _fp_pool, generate_fingerprints, audio, sr
+    )
+    song_id = db.add_song_with_fingerprints(  # type: ignore[union-attr]
+        title, artist, album, duration, file_hash, hashes, offsets
+    )
     if song_id is None:
         return JSONResponse({"status": "error", "message": "Failed to add song"}, status_code=500)
 
-    fps = generate_fingerprints(audio, sr)
-    db.add_fingerprints(song_id, fps)  # type: ignore[union-attr]
-
     return JSONResponse({
         "status": "ok",
         "song_id": song_id,
-        "fingerprints": len(fps),
+        "fingerprints": len(hashes),
         "duration": round(duration, 1),
     })
 
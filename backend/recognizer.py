@@ -1,16 +1,36 @@
 from __future__ import annotations
 
+import atexit
 import base64
-import io
+import hashlib
 import json
 import os
+import random
+import re
 import textwrap
-import urllib.request
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
+import httpx
 import numpy as np
-import soundfile as sf
+
+from backend.audio import resample, to_mono, to_wav_pcm16
+from backend.fingerprint import Fingerprints
+
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # stdlib fallback
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _json_loads = json.loads
 
 # Load .env if python-dotenv is installed
 try:
@@ -27,6 +47,36 @@ OPENAI_MODEL = os.getenv("MUSICA_OPENAI_MODEL", "gpt-4o-audio-preview")
 GEMINI_API_KEY = os.getenv("MUSICA_GEMINI_API_KEY", "")
 GEMINI_MODEL = os.getenv("MUSICA_GEMINI_MODEL", "gemini-2.0-flash")
 
+# With both keys set, ask both providers at once and take the first answer
+# (costs two API calls per recognition)
+HEDGE = os.getenv("MUSICA_HEDGE", "").lower() in ("1", "true", "yes")
+
+# -- HTTP client --------------------------------------------------------------
+
+# Shared keep-alive client, so back-to-back recognitions reuse one warm TLS
+# connection per provider instead of handshaking every call. Built at import
+# because the hedged providers would otherwise race to create it.
+_http_client = httpx.Client(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60.0),
+)
+atexit.register(_http_client.close)
+
+
+# -- Result cache -------------------------------------------------------------
+
+# Identified clips are remembered by their fingerprints (plus an exact digest
+# of their last few seconds), so a client re-sending the same or overlapping
+# audio skips the API
+_CACHE_SIZE = 256
+_CACHE_SECONDS = 15
+_CACHE_MIN_ALIGNED = 32  # time-aligned shared hashes for a near-duplicate hit
+
+# exact key → ((sorted unique hashes, their offsets), result)
+_result_cache: OrderedDict[bytes, tuple[Fingerprints, dict[str, Any]]] = OrderedDict()
+_result_lock = threading.Lock()
+
 # -- Shared prompt ------------------------------------------------------------
 
 _SYSTEM_PROMPT = textwrap.dedent("""\
@@ -64,29 +114,131 @@ _SYSTEM_PROMPT = textwrap.dedent("""\
      {"identified": false, "reason": "brief explanation"}
 """)
 
+_OPENAI_USER_PROMPT = "What song is playing in this audio clip? Listen carefully and identify it."
+
+_GEMINI_PROMPT = (
+    _SYSTEM_PROMPT
+    + "\n\nWhat song is playing in this audio clip? "
+    "Listen very carefully to the LANGUAGE of the vocals first, "
+    "then identify the exact song. Do NOT guess an English song "
+    "if the vocals are in a different language. "
+    "Return JSON only, no extra text."
+)
+
 
 # -- Helpers -----------------------------------------------------------------
 
-def _audio_to_wav_b64(audio: np.ndarray, sr: int) -> str:
-    """Convert numpy audio to base64-encoded WAV."""
-    if audio.ndim > 1:
-        audio = np.mean(audio, axis=1)
+# Clips below these are skipped rather than sent to a provider
+_MIN_AI_SECONDS = 3
+_SILENCE_RMS = 0.005         # ≈ -46 dBFS
+_SILENCE_PEAK = 0.02
+
+# Audio models don't need more bandwidth than this; anything above is
+# downsampled to keep the request body small
+_AI_SAMPLE_RATE = 16000
+
+
+def _audio_to_wav_b64(audio: np.ndarray, sr: int) -> bytes:
+    """Convert numpy audio to base64-encoded 16 kHz WAV (ASCII bytes)."""
+    audio = to_mono(np.asarray(audio, dtype=np.float32))
     # Send all available audio (up to 30 seconds) for best recognition
-    max_samples = sr * 30
-    if len(audio) > max_samples:
-        audio = audio[-max_samples:]
-    buf = io.BytesIO()
-    sf.write(buf, audio, sr, format="WAV", subtype="PCM_16")
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode("ascii")
+    audio = audio[-sr * 30:]
+    if sr > _AI_SAMPLE_RATE:
+        audio, sr = resample(audio, sr, _AI_SAMPLE_RATE), _AI_SAMPLE_RATE
+    return base64.b64encode(to_wav_pcm16(audio, sr))
+
+
+# Stand-in for the audio in request payloads. Each payload is serialised once
+# at import and split around it; requests then only join the real base64 in,
+# so the megabyte-sized string never passes through json
+_AUDIO_SLOT = "__musica_audio__"
+_AUDIO_SLOT_JSON = _json_dumps(_AUDIO_SLOT)
+
+
+def _body_template(payload: dict[str, Any]) -> tuple[bytes, bytes]:
+    """Serialise *payload* into the JSON before and after :data:`_AUDIO_SLOT`."""
+    head, tail = _json_dumps(payload).split(_AUDIO_SLOT_JSON, 1)
+    return head + b'"', b'"' + tail
+
+
+def _fill_body(template: tuple[bytes, bytes], audio_b64: bytes) -> bytes:
+    """Request body from a :func:`_body_template` with *audio_b64* in place."""
+    return b"".join((template[0], audio_b64, template[1]))
+
+
+def _audio_signature(audio: np.ndarray, sr: int, fingerprints: Fingerprints) -> tuple[bytes, Fingerprints]:
+    """Return ``(exact_key, (hashes, offsets))`` for *audio* and its *fingerprints*.
+
+    The key digests the clip's tail; the hashes are made sorted and unique,
+    each with its first time offset, ready for :func:`_aligned_hashes`.
+    """
+    mono = to_mono(np.asarray(audio, dtype=np.float32))
+    tail = np.ascontiguousarray(mono[-sr * _CACHE_SECONDS:])
+    key = hashlib.blake2b(tail, digest_size=16).digest()
+    hashes, offsets = fingerprints
+    hashes, first = np.unique(hashes, return_index=True)
+    return key, (hashes, offsets[first])
+
+
+def _aligned_hashes(a: Fingerprints, b: Fingerprints) -> int:
+    """Tallest offset-delta bin among hashes shared by fingerprint sets *a* and *b*.
+
+    The same test ``find_match`` applies, so overlapping clips of one
+    recording score high even when shifted, and different songs near zero.
+    """
+    (a_hashes, a_offsets), (b_hashes, b_offsets) = a, b
+    if not len(a_hashes) or not len(b_hashes):
+        return 0
+    idx = np.minimum(np.searchsorted(b_hashes, a_hashes), len(b_hashes) - 1)
+    shared = b_hashes[idx] == a_hashes
+    if not shared.any():
+        return 0
+    deltas = b_offsets[idx[shared]].astype(np.int64) - a_offsets[shared]
+    return int(np.bincount(deltas - deltas.min()).max())
+
+
+def _unidentifiable(audio: np.ndarray, sr: int) -> str | None:
+    """Why *audio* isn't worth an API call (too short / near-silent), or None."""
+    mono = to_mono(np.asarray(audio, dtype=np.float32))
+    if len(mono) < sr * _MIN_AI_SECONDS:
+        return f"clip shorter than {_MIN_AI_SECONDS}s"
+    rms = np.sqrt(np.dot(mono, mono) / len(mono))
+    if rms < _SILENCE_RMS or np.abs(mono).max() < _SILENCE_PEAK:
+        return "audio too quiet"
+    return None
+
+
+def _cache_lookup(key: bytes, prints: Fingerprints) -> dict[str, Any] | None:
+    with _result_lock:
+        hit = _result_cache.get(key)
+        if hit is None:
+            for other_key, entry in reversed(_result_cache.items()):  # newest first
+                if _aligned_hashes(prints, entry[0]) >= _CACHE_MIN_ALIGNED:
+                    key, hit = other_key, entry
+                    break
+        if hit is None:
+            return None
+        _result_cache.move_to_end(key)
+        return dict(hit[1])
+
+
+def _cache_store(key: bytes, prints: Fingerprints, result: dict[str, Any]) -> None:
+    with _result_lock:
+        _result_cache[key] = (prints, result)
+        if len(_result_cache) > _CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+
+# ```json ... ``` (any or no language tag) around the reply; group 1 is the body
+_FENCE_RE = re.compile(r"```[\w+-]*\s*(.*?)\s*```$", re.DOTALL)
 
 
 def _parse_ai_response(raw: str) -> dict[str, Any] | None:
     """Parse the JSON from the AI response, stripping markdown fences."""
     text = raw.strip()
-    if text.startswith("```"):
-        text = text.split("\n", 1)[1] if "\n" in text else text[3:]
-        text = text.rsplit("```", 1)[0]
+    fenced = _FENCE_RE.match(text)
+    if fenced:
+        text = fenced.group(1)
 
     def _try_load_json(payload: str) -> dict[str, Any] | None:
         try:
@@ -94,7 +246,8 @@ def _parse_ai_response(raw: str) -> dict[str, Any] | None:
         except json.JSONDecodeError:
             return None
 
-    data = _try_load_json(text)
+    # Only attempt a straight parse on text that can be a JSON object
+    data = _try_load_json(text) if text[:1] == "{" else None
     if data is None:
         start = text.find("{")
         end = text.rfind("}")
@@ -131,13 +284,42 @@ def _ai_result_to_response(data: dict[str, Any]) -> dict[str, Any]:
 
 # ── Public API ───────────────────────────────────────────────────────────────
 
-def recognize_with_ai(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
-    """Send audio to AI for song recognition. Returns result dict or None."""
-    if OPENAI_API_KEY:
-        return _recognize_openai(audio, sr)
-    if GEMINI_API_KEY:
-        return _recognize_gemini(audio, sr)
-    return None
+def recognize_with_ai(
+    audio: np.ndarray,
+    sr: int,
+    fingerprints: Fingerprints | None = None,
+) -> dict[str, Any] | None:
+    """Send audio to AI for song recognition. Returns result dict or None.
+
+    Given the clip's *fingerprints*, clips matching a recently identified one
+    are answered from cache; without them the cache is skipped. Clips too
+    short or too quiet to identify are rejected without a request.
+    """
+    if not is_configured():
+        return None
+
+    reason = _unidentifiable(audio, sr)
+    if reason:
+        print(f"[recognizer] Skipping AI recognition: {reason}")
+        return None
+
+    signature = None
+    if fingerprints is not None:
+        signature = _audio_signature(audio, sr, fingerprints)
+        cached = _cache_lookup(*signature)
+        if cached is not None:
+            return cached
+
+    audio_b64 = _audio_to_wav_b64(audio, sr)
+    if HEDGE and OPENAI_API_KEY and GEMINI_API_KEY:
+        result = _recognize_hedged(audio_b64)
+    elif OPENAI_API_KEY:
+        result = _recognize_openai(audio_b64)
+    else:
+        result = _recognize_gemini(audio_b64)
+    if result and signature is not None:
+        _cache_store(*signature, result)
+    return result
 
 
 def is_configured() -> bool:
@@ -146,6 +328,8 @@ def is_configured() -> bool:
 
 
 def get_provider_name() -> str:
+    if HEDGE and OPENAI_API_KEY and GEMINI_API_KEY:
+        return f"openai/{OPENAI_MODEL} + gemini/{GEMINI_MODEL}"
     if OPENAI_API_KEY:
         return f"openai/{OPENAI_MODEL}"
     if GEMINI_API_KEY:
@@ -153,129 +337,157 @@ def get_provider_name() -> str:
     return ""
 
 
-# ── OpenAI GPT-4o ────────────────────────────────────────────────────────────
+# ── Hedged dispatch ──────────────────────────────────────────────────────────
 
-def _recognize_openai(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
-    """Use GPT-4o with audio input to identify a song."""
-    audio_b64 = _audio_to_wav_b64(audio, sr)
+# Provider calls outlive a hedged request when the other answers first
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="recognizer")
+
+
+def _recognize_hedged(audio_b64: bytes) -> dict[str, Any] | None:
+    """Query OpenAI and Gemini concurrently; first identification wins."""
+    pending = {
+        _hedge_pool.submit(_recognize_openai, audio_b64),
+        _hedge_pool.submit(_recognize_gemini, audio_b64),
+    }
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            if result:
+                for other in pending:
+                    other.cancel()  # only stops calls not yet started
+                return result
+    return None
+
+
+# ── Shared request path ──────────────────────────────────────────────────────
+
+# Rate limits and gateway blips are usually gone within a second or two
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_MAX_ATTEMPTS = 4
 
-    body = json.dumps({
-        "model": OPENAI_MODEL,
-        "messages": [
-            {"role": "system", "content": _SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "What song is playing in this audio clip? Listen carefully and identify it.",
-                    },
-                    {
-                        "type": "input_audio",
-                        "input_audio": {
-                            "data": audio_b64,
-                            "format": "wav",
-                        },
-                    },
-                ],
-            },
-        ],
-        "temperature": 0.3,
-        "max_tokens": 500,
-    }).encode()
-
-    req = urllib.request.Request(
-        "https://api.openai.com/v1/chat/completions",
-        data=body,
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-        },
-    )
 
+def _retry_delay(resp: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before retry *attempt*: Retry-After capped at 2**attempt, plus jitter."""
+    cap = 2.0 ** attempt
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.loads(resp.read())
-    except Exception as e:
-        print(f"[recognizer] OpenAI error: {e}")
-        return None
+        delay = min(float(resp.headers.get("Retry-After", cap)), cap)
+    except ValueError:  # HTTP-date form
+        delay = cap
+    return max(delay, 0.0) + random.uniform(0, 0.5)
+
+
+def _post_json(provider: str, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Any:
+    """POST a JSON *body* and return the decoded response, or None on any failure.
 
+    429 and 5xx responses are retried with capped exponential backoff.
+    """
+    for attempt in range(_MAX_ATTEMPTS):
+        try:
+            resp = _http_client.post(
+                url,
+                content=body,
+                headers={"Content-Type": "application/json", **headers},
+                timeout=timeout,
+            )
+            if resp.status_code in _RETRY_STATUSES and attempt + 1 < _MAX_ATTEMPTS:
+                delay = _retry_delay(resp, attempt)
+                print(f"[recognizer] {provider} HTTP {resp.status_code}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            resp.raise_for_status()
+            return _json_loads(resp.content)
+        except Exception as e:
+            print(f"[recognizer] {provider} error ({type(e).__name__}): {e}")
+            return None
+    return None
+
+
+def _identify(provider: str, data: Any, extract: Callable[[Any], str]) -> dict[str, Any] | None:
+    """Pull the model's reply out of a provider response and parse the song from it."""
+    if data is None:
+        return None
     try:
-        raw = data["choices"][0]["message"]["content"]
-    except (KeyError, IndexError):
-        print(f"[recognizer] OpenAI unexpected response: {data}")
+        raw = extract(data)
+    except (KeyError, IndexError, TypeError):
+        print(f"[recognizer] {provider} unexpected response: {data}")
         return None
 
     parsed = _parse_ai_response(raw)
     if not parsed:
+        print(f"[recognizer] {provider}: song not identified")
         return None
+    print(f"[recognizer] {provider} identified: {parsed.get('song')} by {parsed.get('artist')} ({parsed.get('language', 'unknown')})")
     return _ai_result_to_response(parsed)
 
 
-# ── Google Gemini ────────────────────────────────────────────────────────────
-
-def _recognize_gemini(audio: np.ndarray, sr: int) -> dict[str, Any] | None:
-    """Use Gemini with audio input to identify a song."""
-    audio_b64 = _audio_to_wav_b64(audio, sr)
+# ── OpenAI GPT-4o ────────────────────────────────────────────────────────────
 
-    body = json.dumps({
-        "contents": [
-            {
-                "parts": [
-                    {
-                        "text": (
-                            _SYSTEM_PROMPT
-                            + "\n\nWhat song is playing in this audio clip? "
-                            "Listen very carefully to the LANGUAGE of the vocals first, "
-                            "then identify the exact song. Do NOT guess an English song "
-                            "if the vocals are in a different language. "
-                            "Return JSON only, no extra text."
-                        ),
+_OPENAI_BODY = _body_template({
+    "model": OPENAI_MODEL,
+    "messages": [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": _OPENAI_USER_PROMPT},
+                {
+                    "type": "input_audio",
+                    "input_audio": {
+                        "data": _AUDIO_SLOT,
+                        "format": "wav",
                     },
-                    {
-                        "inline_data": {
-                            "mime_type": "audio/wav",
-                            "data": audio_b64,
-                        },
-                    },
-                ],
-            },
-        ],
-        "generationConfig": {
-            "temperature": 0.1,
-            "maxOutputTokens": 2048,
-            "responseMimeType": "application/json",
+                },
+            ],
         },
-    }).encode()
+    ],
+    "temperature": 0.3,
+    "max_tokens": 500,
+})
 
-    url = (
-        f"https://generativelanguage.googleapis.com/v1beta/models/"
-        f"{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
-    )
 
-    req = urllib.request.Request(
-        url,
-        data=body,
-        headers={"Content-Type": "application/json"},
+def _recognize_openai(audio_b64: bytes) -> dict[str, Any] | None:
+    """Use GPT-4o with base64 WAV audio input to identify a song."""
+    data = _post_json(
+        "OpenAI",
+        "https://api.openai.com/v1/chat/completions",
+        _fill_body(_OPENAI_BODY, audio_b64),
+        {"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        timeout=30.0,
     )
+    return _identify("OpenAI", data, lambda d: d["choices"][0]["message"]["content"])
 
-    try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            data = json.loads(resp.read())
-    except Exception as e:
-        print(f"[recognizer] Gemini error: {e}")
-        return None
 
-    try:
-        raw = data["candidates"][0]["content"]["parts"][0]["text"]
-    except (KeyError, IndexError):
-        print(f"[recognizer] Gemini unexpected response: {data}")
-        return None
+# ── Google Gemini ────────────────────────────────────────────────────────────
 
-    print(f"[recognizer] Gemini raw response: {raw}")
-    parsed = _parse_ai_response(raw)
-    if not parsed:
-        print(f"[recognizer] Gemini: song not identified")
-        return None
-    print(f"[recognizer] Gemini identified: {parsed.get('song')} by {parsed.get('artist')} ({parsed.get('language', 'unknown')})")
-    return _ai_result_to_response(parsed)
+_GEMINI_BODY = _body_template({
+    "contents": [
+        {
+            "parts": [
+                {"text": _GEMINI_PROMPT},
+                {
+                    "inline_data": {
+                        "mime_type": "audio/wav",
+                        "data": _AUDIO_SLOT,
+                    },
+                },
+            ],
+        },
+    ],
+    "generationConfig": {
+        "temperature": 0.1,
+        "maxOutputTokens": 2048,
+        "responseMimeType": "application/json",
+    },
+})
+
+_GEMINI_URL = (
+    f"https://generativelanguage.googleapis.com/v1beta/models/"
+    f"{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
+)
+
+
+def _recognize_gemini(audio_b64: bytes) -> dict[str, Any] | None:
+    """Use Gemini with base64 WAV audio input to identify a song."""
+    data = _post_json("Gemini", _GEMINI_URL, _fill_body(_GEMINI_BODY, audio_b64), {}, timeout=60.0)
+    return _identify("Gemini", data, lambda d: d["candidates"][0]["content"]["parts"][0]["text"])
@@ -2,25 +2,99 @@ from __future__ import annotations
 
 import argparse
 import hashlib
+import mmap
+import multiprocessing
+import os
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import librosa
-
-from backend.config import SAMPLE_RATE, SONGS_DIR
+import numpy as np
+
+from backend.config import (
+    DECODE_CACHE_DIR,
+    DECODE_CACHE_MAX_MB,
+    FINGERPRINT_WORKERS,
+    SAMPLE_RATE,
+    SONGS_DIR,
+)
 from backend.database import Database
-from backend.fingerprint import generate_fingerprints
+from backend.fingerprint import Fingerprints, generate_fingerprints, init_pool_worker
+
+try:
+    from tqdm import tqdm
+except ImportError:  # plain per-file lines instead of a progress bar
+    tqdm = None
+
+_COMMIT_EVERY = 16  # songs per transaction; bounds the work lost to a crash
 
 AUDIO_EXTENSIONS = {".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aac", ".wma", ".opus"}
 
 
 def _file_hash(path: Path) -> str:
-    h = hashlib.md5()
+    """MD5 of the file, hashed straight from a memory map in one C call.
+
+    Stays MD5 so digests match the ones ``/api/songs`` stores for uploads and
+    the ones already in existing databases.
+    """
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
+        if not f.seek(0, 2):
+            return hashlib.md5().hexdigest()  # mmap refuses empty files
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.md5(mm).hexdigest()
+
+
+def _decode(path: Path, fhash: str) -> np.ndarray:
+    """Mono float32 audio at SAMPLE_RATE, cached on disk by file hash.
+
+    Decoding (ffmpeg + resampling) dominates ingest time, so re-ingesting the
+    same files after a fingerprint or schema change reloads the decoded array
+    instead. Samples are kept as float32 so cached and fresh decodes yield
+    identical fingerprints.
+    """
+    if DECODE_CACHE_MAX_MB <= 0:
+        return librosa.load(str(path), sr=SAMPLE_RATE, mono=True)[0]
+
+    cache_path = Path(DECODE_CACHE_DIR) / f"{fhash}-{SAMPLE_RATE}.npy"
+    try:
+        audio = np.load(cache_path, mmap_mode="r")
+        os.utime(cache_path)  # atime isn't reliable (noatime/relatime); mtime drives eviction
+        return audio
+    except (OSError, ValueError):
+        pass
+
+    audio, _ = librosa.load(str(path), sr=SAMPLE_RATE, mono=True)
+    audio = audio.astype(np.float32, copy=False)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, audio)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # caching is best-effort
+    return audio
+
+
+def _evict_decode_cache() -> None:
+    """Trim the decode cache to DECODE_CACHE_MAX_MB, least recently used first."""
+    cache_dir = Path(DECODE_CACHE_DIR)
+    if DECODE_CACHE_MAX_MB <= 0 or not cache_dir.is_dir():
+        return
+    entries = []
+    for f in cache_dir.glob("*.npy"):
+        st = f.stat()
+        entries.append((st.st_mtime, st.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    budget = DECODE_CACHE_MAX_MB * 1024 * 1024
+    for _, size, f in sorted(entries):
+        if total <= budget:
+            break
+        f.unlink(missing_ok=True)
+        total -= size
 
 
 def _extract_metadata(path: Path) -> dict[str, str]:
@@ -42,51 +116,127 @@ def _extract_metadata(path: Path) -> dict[str, str]:
     return meta
 
 
-def ingest_file(
+def _load_and_fingerprint(path: Path, fhash: str) -> tuple[float, Fingerprints, float]:
+    """Decode and fingerprint one file; returns (duration, fingerprints, seconds taken).
+
+    Pure CPU work with no database access, so it can run in a worker process.
+    """
+    t0 = time.time()
+    audio = _decode(path, fhash)
+    duration = len(audio) / SAMPLE_RATE
+    return duration, generate_fingerprints(audio, SAMPLE_RATE), time.time() - t0
+
+
+def _store(
     db: Database,
     path: Path,
+    fhash: str,
+    duration: float,
+    fps: Fingerprints,
+    elapsed: float,
     title: str | None = None,
     artist: str | None = None,
     album: str | None = None,
-) -> bool:
-    """Index a single audio file. Returns True on success."""
-    fhash = _file_hash(path)
-    if db.song_exists(fhash):
-        print(f"  ⏭  Already indexed: {path.name}")
-        return False
+) -> tuple[bool, str]:
+    """Write one fingerprinted file to the database.
+
+    Returns ``(success, status text)``; the caller decides how to show it.
+    """
+    hashes, offsets = fps
+    if not len(hashes):
+        return False, "FAILED (no fingerprints extracted)"
 
     meta = _extract_metadata(path)
     title = title or meta["title"]
     artist = artist or meta["artist"]
     album = album or meta["album"]
 
-    print(f"  🎵 Loading: {path.name} …", end=" ", flush=True)
-    t0 = time.time()
+    song_id = db.add_song_with_fingerprints(title, artist, album, duration, fhash, hashes, offsets)
+    if song_id is None:
+        return False, "FAILED (database error)"
 
-    try:
-        audio, sr = librosa.load(str(path), sr=SAMPLE_RATE, mono=True)
-    except Exception as exc:
-        print(f"FAILED ({exc})")
-        return False
+    return True, (
+        f"OK — {len(hashes):,} fingerprints in {elapsed:.1f}s\n"
+        f"       Title: {title}  |  Artist: {artist}  |  Album: {album}  |  Duration: {duration:.1f}s"
+    )
 
-    duration = len(audio) / sr
-    fps = generate_fingerprints(audio, sr)
 
-    if not fps:
-        print("FAILED (no fingerprints extracted)")
-        return False
+def ingest_files(
+    db: Database,
+    files: list[Path],
+    title: str | None = None,
+    artist: str | None = None,
+    album: str | None = None,
+) -> int:
+    """Index many files, decoding and fingerprinting them in parallel.
+
+    Workers only do the CPU-bound decode/fingerprint step; every database
+    write stays in this process because SQLite allows a single writer, and
+    songs are committed in batches of ``_COMMIT_EVERY``. Returns the number
+    of songs newly indexed.
+    """
+    # hashlib releases the GIL on large buffers, so threads hash files in parallel
+    with ThreadPoolExecutor(max_workers=FINGERPRINT_WORKERS) as hashers:
+        hashed = list(zip(files, hashers.map(_file_hash, files)))
+    existing = db.songs_exist_bulk(fhash for _, fhash in hashed)
+
+    pending: list[tuple[Path, str]] = []
+    for path, fhash in hashed:
+        if fhash in existing:
+            print(f"  ⏭  Already indexed: {path.name}")
+        else:
+            existing.add(fhash)  # identical copies later in the list are skipped too
+            pending.append((path, fhash))
+
+    workers = min(FINGERPRINT_WORKERS, len(pending))
+    pool = None
+    if workers > 1:
+        # Spawned: the hashing threads above make forking unsafe
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_pool_worker,
+        )
+    if pool is not None:
+        jobs = [pool.submit(_load_and_fingerprint, path, fhash).result for path, fhash in pending]
+    else:
+        jobs = [partial(_load_and_fingerprint, path, fhash) for path, fhash in pending]
 
-    song_id = db.add_song(title, artist, album, duration, fhash)
-    if song_id is None:
-        print("FAILED (database error)")
-        return False
+    # One progress bar on a terminal; the per-file lines otherwise (logs, pipes)
+    bar = tqdm(total=len(pending), unit="song", desc="Ingesting") if tqdm and sys.stdout.isatty() else None
 
-    db.add_fingerprints(song_id, fps)
-    elapsed = time.time() - t0
+    def report(path: Path, status: str, postfix: str = "") -> None:
+        if bar is None:
+            print(f"  🎵 Loading: {path.name} … {status}")
+            return
+        if postfix:
+            bar.set_postfix_str(postfix, refresh=False)
+        else:
+            bar.write(f"  🎵 {path.name} … {status}")
+        bar.update()
 
-    print(f"OK — {len(fps):,} fingerprints in {elapsed:.1f}s")
-    print(f"       Title: {title}  |  Artist: {artist}  |  Album: {album}  |  Duration: {duration:.1f}s")
-    return True
+    ok = 0
+    try:
+        for start in range(0, len(pending), _COMMIT_EVERY):
+            # Fingerprint the whole batch before taking the write lock, so the
+            # server is only blocked for the inserts themselves.
+            batch = []
+            for (path, fhash), job in zip(pending[start:start + _COMMIT_EVERY], jobs[start:]):
+                try:
+                    batch.append((path, fhash, *job()))
+                except Exception as exc:
+                    report(path, f"FAILED ({exc})")
+            with db.transaction():
+                for path, fhash, duration, fps, elapsed in batch:
+                    stored, status = _store(db, path, fhash, duration, fps, elapsed, title, artist, album)
+                    ok += stored
+                    report(path, status, f"{path.name} → {len(fps[0]):,} fps ({elapsed:.1f}s)" if stored else "")
+    finally:
+        if bar is not None:
+            bar.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return ok
 
 
 def main() -> None:
@@ -125,10 +275,8 @@ def main() -> None:
 
     print(f"\n🎶 Musica Ingestion — {len(files)} file(s)\n")
 
-    ok = 0
-    for f in files:
-        if ingest_file(db, f, args.title, args.artist, args.album):
-            ok += 1
+    ok = ingest_files(db, files, args.title, args.artist, args.album)
+    _evict_decode_cache()
 
     stats = db.get_stats()
     print(f"\n✅  Done — {ok} new song(s) indexed")
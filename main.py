@@ -0,0 +1,20 @@
+"""Musica — Server entry point."""
+
+import uvicorn
+
+from backend.config import DEV, HOST, PORT, WORKERS
+
+if __name__ == "__main__":
+    if DEV:
+        # Reload watches the source tree and always runs a single worker
+        uvicorn.run("backend.main:app", host=HOST, port=PORT, reload=True)
+    else:
+        # loop/http default to "auto": uvloop and httptools when installed
+        # (uvicorn[standard]), asyncio and h11 otherwise
+        uvicorn.run(
+            "backend.main:app",
+            host=HOST,
+            port=PORT,
+            workers=WORKERS,
+            log_level="info",
+        )